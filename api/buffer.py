@@ -0,0 +1,241 @@
+import asyncio
+import orjson
+import os
+import traceback
+from db import flush_rows
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from typing import List
+
+"""
+This script implements the API's optional write-behind mode, turned on by
+setting the `WRITE_BEHIND` environment variable.
+
+In this mode the `POST /responses` and `POST /responses/noconsent` endpoints
+don't write to Postgres themselves. Instead each row is appended to a journal
+file and kept in memory, and the request is acknowledged once the journal is
+on disk. The journal is synced to disk for many requests at once, as they
+arrive together. A background task then stores the buffered rows with
+multi-row inserts, one transaction per flush, every `FLUSH_INTERVAL` seconds
+or as soon as `FLUSH_ROWS` rows are waiting. Rows that were still buffered
+when the API went down are read back from the journal when it starts again.
+
+Buffered rows only show up in the read endpoints (and their ETags only
+change) once they've been flushed. A response is acknowledged as new unless
+its Prolific ID is already buffered, since the database is only checked for
+duplicates at flush time. The combined `POST /submit` endpoint always writes
+straight to the database.
+"""
+
+env_vars = os.environ
+
+WRITE_BEHIND = env_vars.get("WRITE_BEHIND")
+WRITE_BEHIND_JOURNAL = env_vars.get("WRITE_BEHIND_JOURNAL", "write_behind.jsonl")
+
+# Flush the buffer once this many rows are waiting, or at least this often
+# (in seconds)
+FLUSH_ROWS = 500
+FLUSH_INTERVAL = 0.05
+
+
+class WriteBuffer:
+    """
+    Buffers posted rows in memory, backed by an append-only journal, and
+    flushes them to the database in the background.
+
+    Journal entries are numbered. Each flush appends the number of the last
+    entry it stored, and the journal is emptied whenever the buffer is,
+    either of which is synced to disk before the flush is done.
+    Rows that can't be stored even on their own (e.g. because they refer to
+    a batch that doesn't exist) are set aside in a `.rejected` file next to
+    the journal.
+    """
+
+    def __init__(self, path: str, engine: AsyncEngine):
+        self.path = path
+        self.engine = engine
+        self.journal = None
+        self.responses = []
+        self.no_consent = []
+        self.prolific_ids = set()
+        # The number of the last journal entry written, and synced to disk
+        self.written = 0
+        self.synced = 0
+        self.syncing = None
+        self.full = asyncio.Event()
+        self.stopped = False
+        self.task = None
+
+    async def add(self, table: str, row: dict):
+        """Buffer a row for `table`, returning once it's journaled on disk"""
+        self.written += 1
+        self.write({"entry": self.written, "table": table, "row": row})
+        self.buffer(table, row)
+        await self.sync()
+
+    async def add_no_consent(self, row: dict):
+        """Buffer a NoConsent row"""
+        await self.add("noconsent", row)
+
+    async def add_response(self, response: dict) -> bool:
+        """
+        Buffer a user's response. Returns False if a response with the same
+        Prolific ID is already buffered (so it's dropped), otherwise True.
+        """
+        if self.contains(response["prolific_id"]):
+            return False
+        await self.add("response", response)
+        return True
+
+    def buffer(self, table: str, row: dict):
+        """Hold a (journaled) row in memory until the next flush"""
+        if table == "response":
+            self.responses.append(row)
+            if row["prolific_id"] is not None:
+                self.prolific_ids.add(row["prolific_id"])
+        else:
+            self.no_consent.append(row)
+        if len(self.responses) + len(self.no_consent) >= FLUSH_ROWS:
+            self.full.set()
+
+    def contains(self, prolific_id: str | None) -> bool:
+        """Whether a response from `prolific_id` is waiting to be flushed"""
+        return prolific_id is not None and prolific_id in self.prolific_ids
+
+    async def flush(self):
+        """Store every buffered row in the database"""
+        if not self.responses and not self.no_consent:
+            return
+        responses, self.responses = self.responses, []
+        no_consent, self.no_consent = self.no_consent, []
+        prolific_ids = [r["prolific_id"] for r in responses]
+        flushed = self.written
+        failed = False
+        try:
+            try:
+                await flush_rows(responses, no_consent, self.engine)
+            except (DataError, IntegrityError):
+                # Some row is bad; store the rest and set the bad ones aside
+                await self.flush_each(responses, no_consent)
+        except Exception:
+            # Most likely the database is unavailable; try again next time,
+            # with just the rows that weren't stored yet. (The journal isn't
+            # marked, so any rows `flush_each` did store would be stored
+            # again if the API went down before the next flush.)
+            traceback.print_exc()
+            self.responses = responses + self.responses
+            self.no_consent = no_consent + self.no_consent
+            failed = True
+        self.prolific_ids.difference_update(prolific_ids)
+        self.prolific_ids.update(r["prolific_id"] for r in self.responses)
+        self.prolific_ids.discard(None)
+        if failed:
+            return
+        if self.responses or self.no_consent:
+            self.write({"flushed": flushed})
+        else:
+            self.journal.truncate(0)
+        # Until this is on disk, the flushed rows would be stored again if
+        # the API went down
+        await asyncio.to_thread(os.fsync, self.journal.fileno())
+
+    async def flush_each(self, responses: List[dict], no_consent: List[dict]):
+        """
+        Store rows one at a time, setting aside those that are rejected.
+        Each row is removed from its list once it's stored or set aside, so
+        if this fails partway the lists hold just the rows still to flush.
+        """
+        for table, rows in (("response", responses), ("noconsent", no_consent)):
+            while rows:
+                row = rows[0]
+                try:
+                    if table == "response":
+                        await flush_rows([row], [], self.engine)
+                    else:
+                        await flush_rows([], [row], self.engine)
+                except (DataError, IntegrityError) as error:
+                    print(f"Rejected buffered {table} row: {error.orig}")
+                    with open(self.path + ".rejected", "ab") as rejected:
+                        rejected.write(orjson.dumps({"table": table, "row": row}))
+                        rejected.write(b"\n")
+                rows.pop(0)
+
+    async def fsync(self):
+        """Sync every journal entry written so far to disk"""
+        written = self.written
+        try:
+            await asyncio.to_thread(os.fsync, self.journal.fileno())
+            self.synced = written
+        finally:
+            self.syncing = None
+
+    def replay(self):
+        """
+        Buffer the rows that hadn't been flushed when the API last went down
+        and rewrite the journal with just those.
+        """
+        entries = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as journal:
+                for line in journal:
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # A partly written entry, from going down mid-write
+                        continue
+                    if "flushed" in entry:
+                        flushed = entry["flushed"]
+                        entries = [e for e in entries if e["entry"] > flushed]
+                    else:
+                        entries.append(entry)
+        # Write the new journal alongside the old one and then swap them, so
+        # that going down in between doesn't lose anything
+        with open(self.path + ".new", "wb") as journal:
+            for entry in entries:
+                journal.write(orjson.dumps(entry) + b"\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(self.path + ".new", self.path)
+        self.journal = open(self.path, "ab")
+        for entry in entries:
+            self.written = max(self.written, entry["entry"])
+            self.buffer(entry["table"], entry["row"])
+        self.synced = self.written
+        if entries:
+            print(f"Replaying {len(entries)} buffered row(s) from the journal")
+
+    async def run(self):
+        """Flush the buffer whenever it fills up or `FLUSH_INTERVAL` passes"""
+        while not self.stopped:
+            try:
+                await asyncio.wait_for(self.full.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            await self.flush()
+
+    async def start(self):
+        """Replay the journal and start flushing in the background"""
+        self.replay()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop flushing in the background and flush what's left"""
+        self.stopped = True
+        self.full.set()
+        await self.task
+        await self.flush()
+        self.journal.close()
+
+    async def sync(self):
+        """Wait until every journal entry written so far is on disk"""
+        written = self.written
+        while self.synced < written:
+            if self.syncing is None:
+                self.syncing = asyncio.create_task(self.fsync())
+            await asyncio.shield(self.syncing)
+
+    def write(self, entry: dict):
+        """Append an entry to the journal"""
+        self.journal.write(orjson.dumps(entry) + b"\n")
+        self.journal.flush()
@@ -0,0 +1,131 @@
+import secrets
+from collections import Counter
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from tables import Metadata
+from templates import compile_rows
+from types import MappingProxyType
+
+"""
+This script holds the API's in-process caches. Everything cached here is
+derived from rows that never change once they're written (e.g. the Pi values
+of a batch or the arms' Metadata), so entries never go stale; they're only
+dropped once they're no longer useful.
+
+It also keeps a version counter per table, bumped whenever the API commits a
+change to that table, from which the read endpoints derive their ETags (see
+`etag`). The counters live in memory, which relies on the database only being
+written through this (single) API process.
+"""
+
+# How many batches' arm samplers to keep around at most
+MAX_CACHED_SAMPLERS = 16
+
+# A random token identifying this process. It's part of every ETag, so that
+# tags handed out before a restart (when the counters start over) never match.
+BOOT_ID = secrets.token_hex(4)
+
+# How many times each table has changed since the API started, by table name
+table_versions = Counter()
+
+# Arm samplers (see `randomize.AliasSampler`) keyed by batch id
+arm_samplers = {}
+
+# Every Metadata row as a read-only mapping, ordered by id, the same
+# profiles grouped by arm id, and each arm's pre-rendered HTML table rows
+# (see `templates.compile_rows`). All are None until they're first loaded.
+metadata = None
+arm_profiles = None
+arm_rows = None
+
+
+def bump(*tables: str):
+    """
+    Record that `tables` have changed. Call this only once the change is
+    committed, so that a new ETag is never paired with old data.
+    """
+    for table in tables:
+        table_versions[table] += 1
+
+
+def clear_metadata():
+    """Forget the cached metadata so that it's reloaded on next use"""
+    global metadata, arm_profiles, arm_rows
+    metadata = None
+    arm_profiles = None
+    arm_rows = None
+
+
+def etag(*tables: str) -> str:
+    """
+    An ETag for data read from `tables`, which changes whenever they do. It's
+    a weak tag since the same data may be sent with or without compression.
+    """
+    versions = "-".join(str(table_versions[table]) for table in tables)
+    return f'W/"{BOOT_ID}-{versions}"'
+
+
+async def get_arm_profiles(engine: AsyncEngine) -> MappingProxyType:
+    """Retrieve each arm's (read-only) metadata profiles, keyed by arm id"""
+    if arm_profiles is not None:
+        return arm_profiles
+    _, grouped, _ = await load_metadata(engine)
+    return grouped
+
+
+async def get_arm_rows(engine: AsyncEngine) -> MappingProxyType:
+    """Retrieve each arm's pre-rendered HTML table rows, keyed by arm id"""
+    if arm_rows is not None:
+        return arm_rows
+    _, _, rows = await load_metadata(engine)
+    return rows
+
+
+async def get_metadata(engine: AsyncEngine) -> tuple:
+    """Retrieve every (read-only) Metadata profile, ordered by id"""
+    if metadata is not None:
+        return metadata
+    profiles, _, _ = await load_metadata(engine)
+    return profiles
+
+
+def get_sampler(batch_id: int):
+    """Retrieve the cached arm sampler for a batch, if there is one"""
+    return arm_samplers.get(batch_id)
+
+
+async def load_metadata(engine: AsyncEngine):
+    """
+    Load every arm's Metadata profiles into memory and pre-render their HTML
+    table rows. Nothing is cached while the table is still empty (i.e. before
+    the bandit has been initialized).
+    """
+    global metadata, arm_profiles, arm_rows
+    async with AsyncSession(engine) as session:
+        rows = (await session.exec(select(Metadata).order_by(Metadata.id))).all()
+    profiles = tuple(MappingProxyType(row.model_dump()) for row in rows)
+    grouped = {}
+    for profile in profiles:
+        grouped.setdefault(profile["arm_id"], []).append(profile)
+    grouped = MappingProxyType({k: tuple(v) for k, v in grouped.items()})
+    rows = MappingProxyType({k: compile_rows(v) for k, v in grouped.items()})
+    if profiles:
+        metadata = profiles
+        arm_profiles = grouped
+        arm_rows = rows
+    return profiles, grouped, rows
+
+
+def roll_forward(batch_id: int):
+    """Drop the arm samplers of every batch older than `batch_id`"""
+    for cached_id in list(arm_samplers.keys()):
+        if cached_id < batch_id:
+            arm_samplers.pop(cached_id, None)
+
+
+def set_sampler(batch_id: int, sampler):
+    """Cache the arm sampler for a batch, evicting the oldest if full"""
+    arm_samplers[batch_id] = sampler
+    while len(arm_samplers) > MAX_CACHED_SAMPLERS:
+        arm_samplers.pop(min(arm_samplers.keys()))
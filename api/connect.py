@@ -1,11 +1,14 @@
 import os
 from sqlalchemy import URL
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import create_engine
-from db import create_tables
+from db import backfill_outcomes, create_tables
+from migrations import migrate
 
 """
-This script connects to the Postgres database and creates the tables
-initialized in `tables.py`
+This script connects to the Postgres database, creates the tables
+initialized in `tables.py` and applies any pending schema migrations (see
+`migrations.py`)
 """
 
 env_vars = os.environ
@@ -30,6 +33,19 @@ url = URL.create(
     database=DB_USER,
 )
 engine = create_engine(url, echo=False)
+# The async engine backs every endpoint that runs on the event loop. Its pool
+# is sized so that a burst of participants doesn't queue on connections.
+async_engine = create_async_engine(
+    url.set(drivername="postgresql+asyncpg"),
+    echo=False,
+    pool_size=20,
+    max_overflow=20,
+    pool_pre_ping=True,
+)
 
 # Create the tables initialized in tables.py
 create_tables(engine)
+# Bring tables made by earlier versions of the API up to date
+migrate(engine)
+# Seed the per-arm outcome counters if they're new to this database
+backfill_outcomes(engine)
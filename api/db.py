@@ -1,90 +1,591 @@
+import asyncio
+import cache
+from collections import Counter
+from contextlib import asynccontextmanager
 from randomize import draw_arms
-from sqlalchemy import Engine
+from sqlalchemy import (
+    Boolean,
+    Engine,
+    Text,
+    and_,
+    cast,
+    column,
+    exists,
+    func,
+    literal,
+    table,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
 from sqlmodel import Session, SQLModel, select
-from tables import Bandit, Batch, Metadata, NoConsent, Parameters, Pi, Response
-from typing import List
+from sqlmodel.ext.asyncio.session import AsyncSession
+from tables import (
+    Bandit,
+    Batch,
+    CurrentBatch,
+    Metadata,
+    NoConsent,
+    Outcomes,
+    Parameters,
+    Pi,
+    Response,
+    Submission,
+)
+from response_models import NoConsentJSON, ResponseJSON
+from typing import AsyncIterator, List
 
 """
 This script provides utility function for the API to interact with the
 Postgres db.
+
+Most helpers are coroutines that run against the async engine so that the
+API can keep many requests in flight without tying up worker threads. The
+read helpers return rows as plain dicts rather than ORM objects, so the API
+can serialize them directly, and the ones that return related rows
+(`get_bandit`, `get_batches`, `get_parameters`, `get_pi`) fetch them with a
+fixed number of queries rather than one per row. The `add_*` helpers (and
+`advance_batch`) only stage rows in a caller's session without committing,
+so that several of them can share a single transaction (see `submit`).
+`flush_rows` stores many buffered rows at once with multi-row inserts (see
+`buffer.py`), and `copy_responses` loads large sets of responses with COPY
+(see `ingest.py`). The `export_*` helpers read whole tables for the export
+endpoints from a read-only snapshot (see `snapshot`).
+
+The list helpers accept `after_id`/`limit` for keyset pagination, and each
+has a `stream_*` counterpart that yields rows from a server-side cursor so
+large tables never have to be held in memory at once.
 """
 
+# How many rows a server-side cursor fetches per round trip when streaming
+STREAM_CHUNK_SIZE = 500
+
+# How many rows the export helpers read per round trip, and how many chunks
+# of CSV may wait to be sent to the client
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_QUEUE_SIZE = 16
+
+# How many rows a multi-row insert writes at most (Postgres caps the number
+# of parameters a statement can have)
+INSERT_CHUNK_SIZE = 1000
+
+
+async def add_batch(
+    labels: List[str],
+    remaining: int,
+    active: bool,
+    pi: dict,
+    params: dict,
+    session: AsyncSession,
+) -> int:
+    """
+    Add a new batch together with its `Parameters` and `Pi` rows to `session`
+    without committing, so that it can be part of a larger transaction.
+    See `generate_batch`. Returns the id of the new batch.
+    """
+    batch_obj = Batch(remaining=remaining, active=active)
+    session.add(batch_obj)
+    # Flush so that the database assigns the new batch its id
+    await session.flush()
+    # The newest batch is the current one, as long as it can take responses
+    if active and remaining is not None and remaining > 0:
+        await set_current_batch(batch_obj.id, session)
+    await add_parameters(labels, batch_obj.id, params, session)
+    await add_pi(labels, batch_obj.id, pi, session)
+    return batch_obj.id
+
+
+async def add_parameters(
+    labels: List[str], batch_id: int, params: dict, session: AsyncSession
+):
+    """
+    Add a batch's Bandit parameters to `session` without committing
+
+    `params` is a dictionary with keys equal to `labels` and the values
+    being a dictionary containing "alpha" and "beta" values parameterizing
+    the beta distribution in each arm. E.g.
+    ```
+    params: {
+        "arm1": {"alpha": 1, "beta": 1},
+        "arm2": {"alpha": 1, "beta": 1},
+        "arm3": {"alpha": 1, "beta": 1},
+        "arm4": {"alpha": 1, "beta": 1}
+    }
+    ```
+    """
+    # Get the corresponding Bandit arms
+    arm_ids = await get_arm_ids(labels, session)
+    for label in labels:
+        arm_params = params[label]
+        ## TODO: Is there a way to make this distribution agnostic.
+        ## E.g. we could switch from Bernoulli with beta prior to
+        ## a Gaussian with a Gaussian prior and the code stays the same?
+        param_obj = Parameters(
+            arm_id=arm_ids[label],
+            batch_id=batch_id,
+            alpha=arm_params["alpha"],
+            beta=arm_params["beta"],
+        )
+        session.add(param_obj)
+
+
+async def add_pi(labels: List[str], batch_id: int, pi: dict, session: AsyncSession):
+    """
+    Add a batch's Bandit Pi values to `session` without committing
+
+    `pi` should be a dictionary where the keys are the `labels`, and the values
+    are floats indicating the % of realizations drawn from the posterior
+    distribution of each arm that the corresponding arm is the max/min
+    discriminatory context.
+
+    E.g.
+    pi = {"arm1": 0.25, "arm2": 0.5, "arm3": 0.75, "arm4": 1}
+    """
+    # Get the corresponding Bandit arms
+    arm_ids = await get_arm_ids(labels, session)
+    for label in labels:
+        # Get corresponding pi value
+        arm_pi = pi[label]
+        pi_obj = Pi(batch_id=batch_id, arm_id=arm_ids[label], pi=arm_pi)
+        session.add(pi_obj)
+
+
+async def add_response(response: dict, session: AsyncSession) -> int | None:
+    """
+    Add a user's response to `session` without committing, unless the same
+    Prolific ID has already responded. Duplicates are dropped by the insert
+    statement itself (and by the unique index on valid responses, so that
+    concurrent submissions can't both get in). The conflict has no target, so
+    inserts still work on a database where that index couldn't be built. The
+    per-arm `Outcomes` counters are kept in step with the new response.
+    Returns the id of the new response, or None if it was a duplicate.
+    """
+    columns = Response.__table__.columns
+    values = select(*[literal(v, columns[k].type) for k, v in response.items()])
+    if response["prolific_id"] is not None:
+        values = values.where(
+            ~exists().where(Response.prolific_id == response["prolific_id"])
+        )
+    statement = (
+        insert(Response)
+        .from_select(list(response.keys()), values)
+        .on_conflict_do_nothing()
+        .returning(Response.id)
+    )
+    response_id = (await session.exec(statement)).scalar()
+    if response_id is None:
+        return None
+    await count_outcomes([response], session)
+    return response_id
+
+
+async def add_responses(responses: List[dict], session: AsyncSession) -> List[int]:
+    """
+    Add many users' responses to `session` at once without committing. As
+    with `add_response`, responses from Prolific IDs that have already
+    responded (or that appear earlier in `responses`) are dropped, and the
+    per-arm `Outcomes` counters are kept in step. Returns the ids of the new
+    responses.
+    """
+    prolific_ids = {r["prolific_id"] for r in responses} - {None}
+    seen = set()
+    if prolific_ids:
+        statement = select(Response.prolific_id).where(
+            Response.prolific_id.in_(prolific_ids)
+        )
+        seen = set((await session.exec(statement)).all())
+    new = []
+    for response in responses:
+        if response["prolific_id"] is not None:
+            if response["prolific_id"] in seen:
+                continue
+            seen.add(response["prolific_id"])
+        new.append(response)
+    if not new:
+        return []
+    statement = (
+        insert(Response)
+        .values(new)
+        .on_conflict_do_nothing()
+        .returning(*columns(Response))
+    )
+    rows = (await session.exec(statement)).mappings().all()
+    await count_outcomes(rows, session)
+    return [row["id"] for row in rows]
+
+
+async def advance_batch(
+    batch_id: int,
+    remaining: int,
+    active: bool,
+    maximum: bool,
+    pi_method: str,
+    session: AsyncSession,
+) -> tuple:
+    """
+    Add the batch that follows `batch_id` to `session` without committing.
+    The arms' posteriors are updated with the batch's outcomes and a fresh
+    set of Pi values is drawn from them, computed by `pi_method` (see
+    `draw_arms`). Returns the new batch id and its (cumulative) Pi values.
+    """
+    # Collect every arm's current parameters together with its successes and
+    # failures in this batch, read from the running `Outcomes` counters.
+    ## TODO: related to the above. Is there a way to update the
+    ## posterior distribution in a distribution-agnostic way?
+    statement = (
+        select(
+            Bandit.label,
+            Parameters.alpha,
+            Parameters.beta,
+            func.coalesce(Outcomes.successes, 0),
+            func.coalesce(Outcomes.failures, 0),
+        )
+        .join(Parameters, Parameters.arm_id == Bandit.id)
+        .outerjoin(
+            Outcomes,
+            and_(Outcomes.arm_id == Bandit.id, Outcomes.batch_id == batch_id),
+        )
+        .where(Parameters.batch_id == batch_id)
+        .order_by(Bandit.id)
+    )
+    arms = (await session.exec(statement)).all()
+    # Construct the labels and updated alpha and beta parameters for each arm
+    labels = []
+    params = {}
+    for arm_label, alpha, beta, successes, failures in arms:
+        labels.append(arm_label)
+        params[arm_label] = {"alpha": alpha + successes, "beta": beta + failures}
+    # Construct updated Pi value for each arm. The simulation is CPU-bound so
+    # it runs in a worker thread rather than on the event loop.
+    pi = await asyncio.to_thread(draw_arms, params, max=maximum, method=pi_method)
+    print(f"{pi}")
+    # Now update the `Batch`, `Parameters` and `Pi` tables
+    new_batch_id = await add_batch(
+        labels=labels,
+        remaining=remaining,
+        active=active,
+        pi=pi,
+        params=params,
+        session=session,
+    )
+    return new_batch_id, pi
+
+
+def async_session(engine: AsyncEngine) -> AsyncSession:
+    """Open an AsyncSession whose objects remain readable after commit"""
+    return AsyncSession(engine, expire_on_commit=False)
+
+
+def backfill_outcomes(engine: Engine):
+    """
+    Seed the `Outcomes` counters from the existing responses. This only does
+    anything when the counters are empty, e.g. for a study that was started
+    before the table existed.
+    """
+    with Session(engine) as session:
+        if session.exec(select(Outcomes).limit(1)).first() is not None:
+            return
+        counts = (
+            select(
+                Response.batch_id,
+                Response.arm_id,
+                func.count(Response.id).filter(Response.discriminated == True),
+                func.count(Response.id).filter(Response.discriminated == False),
+            )
+            .where(Response.garbage != True)
+            .where(Response.discriminated != None)
+            .group_by(Response.batch_id, Response.arm_id)
+        )
+        columns = ["batch_id", "arm_id", "successes", "failures"]
+        session.exec(insert(Outcomes).from_select(columns, counts))
+        session.commit()
+
+
+async def claim_submission(submission_id: str, session: AsyncSession) -> dict | None:
+    """
+    Claim a submission's idempotency key in `session`. Returns None if the
+    submission is new, otherwise the outcome it was given the first time.
+    While another transaction holds the same key, this waits for it to end.
+    """
+    statement = (
+        insert(Submission)
+        .values(id=submission_id)
+        .on_conflict_do_nothing()
+        .returning(Submission.id)
+    )
+    if (await session.exec(statement)).first() is not None:
+        return None
+    statement = select(Submission).where(Submission.id == submission_id)
+    recorded = (await session.exec(statement)).one()
+    return recorded.model_dump(exclude={"id"})
+
+
+async def clear_current_batch(batch_id: int, session: AsyncSession):
+    """Clear the current batch pointer if it points at `batch_id`"""
+    statement = (
+        update(CurrentBatch)
+        .where(CurrentBatch.batch_id == batch_id)
+        .values(batch_id=None)
+    )
+    await session.exec(statement)
+
+
+def columns(model) -> list:
+    """A model's table columns, to select its rows as plain tuples"""
+    return list(model.__table__.columns)
+
+
+async def copy_responses(
+    responses: List[dict], engine: AsyncEngine
+) -> List[int | None]:
+    """
+    Store many users' responses at once using Postgres' COPY. The rows are
+    copied into a temporary table and moved into `response` from there so
+    that, as with `add_response`, responses from Prolific IDs that have
+    already responded are dropped. Every response is assigned its id up
+    front, which is how the new ids are matched back to `responses`. Returns
+    each response's id, or None if it was a duplicate. Repeated Prolific IDs
+    within `responses` must be dropped beforehand.
+    """
+    if not responses:
+        return []
+    names = [c.name for c in columns(Response)]
+    staged = table("response_copy", *[column(name) for name in names])
+    async with async_session(engine) as session:
+        sequence = func.pg_get_serial_sequence(Response.__tablename__, "id")
+        statement = select(func.nextval(sequence)).select_from(
+            func.generate_series(1, len(responses))
+        )
+        ids = (await session.exec(statement)).all()
+        await session.exec(
+            text("CREATE TEMPORARY TABLE response_copy (LIKE response) ON COMMIT DROP")
+        )
+        records = [
+            (response_id, *[response[name] for name in names[1:]])
+            for response_id, response in zip(ids, responses)
+        ]
+        connection = await (await session.connection()).get_raw_connection()
+        await connection.driver_connection.copy_records_to_table(
+            "response_copy", records=records, columns=names
+        )
+        values = select(*[staged.c[name] for name in names]).where(
+            ~exists().where(Response.prolific_id == staged.c.prolific_id)
+        )
+        statement = (
+            insert(Response)
+            .from_select(names, values)
+            .on_conflict_do_nothing()
+            .returning(
+                Response.id,
+                Response.arm_id,
+                Response.batch_id,
+                Response.discriminated,
+                Response.garbage,
+            )
+        )
+        rows = (await session.exec(statement)).mappings().all()
+        await count_outcomes(rows, session)
+        await session.commit()
+    if rows:
+        cache.bump("response", "outcomes")
+    new = {row["id"] for row in rows}
+    return [response_id if response_id in new else None for response_id in ids]
+
+
+async def count_outcomes(responses: List[dict], session: AsyncSession):
+    """Add the outcomes of the valid `responses` to their arms' running counts"""
+    counts = Counter()
+    for response in responses:
+        if response["garbage"] or response["discriminated"] is None:
+            continue
+        key = (response["batch_id"], response["arm_id"])
+        counts[key + (response["discriminated"],)] += 1
+    keys = sorted({key[:2] for key in counts})
+    if not keys:
+        return
+    statement = insert(Outcomes).values(
+        [
+            dict(
+                batch_id=batch_id,
+                arm_id=arm_id,
+                successes=counts[(batch_id, arm_id, True)],
+                failures=counts[(batch_id, arm_id, False)],
+            )
+            for batch_id, arm_id in keys
+        ]
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[Outcomes.batch_id, Outcomes.arm_id],
+        set_={
+            "successes": Outcomes.successes + statement.excluded.successes,
+            "failures": Outcomes.failures + statement.excluded.failures,
+        },
+    )
+    await session.exec(statement)
+
 
 def create_tables(engine: Engine):
     """Creates the tables specified in `tables.py` in the Postgres db"""
     SQLModel.metadata.create_all(engine)
 
 
-def deactivate_batch(batch_id: int, engine: Engine):
+async def deactivate_batch(batch_id: int, engine: AsyncEngine):
     """Deactivate a currently active batch"""
-    with Session(engine) as session:
-        batch_obj = session.exec(select(Batch).where(Batch.id == batch_id)).one()
+    async with async_session(engine) as session:
+        batch_obj = (
+            await session.exec(select(Batch).where(Batch.id == batch_id))
+        ).one()
         batch_obj.active = False
         session.add(batch_obj)
-        session.commit()
+        await clear_current_batch(batch_id, session)
+        await session.commit()
+    cache.bump("batch")
 
 
-def decrement_batch(batch_id: int, active: bool, engine: Engine):
+async def decrement_batch(batch_id: int, active: bool, engine: AsyncEngine):
     """Decrement the `remaining` parameter of a given batch"""
-    with Session(engine) as session:
-        batch_obj = session.exec(select(Batch).where(Batch.id == batch_id)).one()
+    async with async_session(engine) as session:
+        batch_obj = (
+            await session.exec(select(Batch).where(Batch.id == batch_id))
+        ).one()
         batch_obj.remaining = batch_obj.remaining - 1
         batch_obj.active = active
         session.add(batch_obj)
-        session.commit()
+        if not active or batch_obj.remaining <= 0:
+            await clear_current_batch(batch_id, session)
+        await session.commit()
+    cache.bump("batch")
+
+
+async def export_csv(model, engine: AsyncEngine) -> AsyncIterator[bytes]:
+    """
+    Yield a model's whole table as CSV (with a header row), as produced by
+    Postgres' `COPY ... TO STDOUT`. Booleans are written as true/false,
+    which CSV readers recognize, rather than Postgres' t/f.
+    """
+    statement = select(
+        *[
+            cast(c, Text).label(c.name) if isinstance(c.type, Boolean) else c
+            for c in columns(model)
+        ]
+    ).order_by(model.id)
+    query = str(statement.compile(dialect=postgresql.dialect()))
+    # COPY hands over the data through a callback, so it runs in a task of
+    # its own and passes the data on through a (bounded) queue
+    chunks = asyncio.Queue(maxsize=EXPORT_QUEUE_SIZE)
+
+    async def copy():
+        try:
+            async with snapshot(engine) as connection:
+                raw_connection = await connection.get_raw_connection()
+                await raw_connection.driver_connection.copy_from_query(
+                    query, output=chunks.put, format="csv", header=True
+                )
+            await chunks.put(None)
+        except Exception as error:
+            await chunks.put(error)
+
+    task = asyncio.create_task(copy())
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield bytes(chunk)
+    finally:
+        task.cancel()
+
+
+async def export_rows(model, engine: AsyncEngine) -> AsyncIterator[List[tuple]]:
+    """
+    Yield a model's whole table, as lists of up to `EXPORT_CHUNK_SIZE` rows
+    (tuples of the table's columns), from a server-side cursor
+    """
+    statement = select(*columns(model)).order_by(model.id)
+    async with snapshot(engine) as connection:
+        rows = await connection.stream(
+            statement.execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        async for chunk in rows.partitions():
+            yield [tuple(row) for row in chunk]
 
 
-def generate_bandit(labels: List[str], engine: None | Engine):
+async def flush_rows(
+    responses: List[dict], no_consent: List[dict], engine: AsyncEngine
+) -> int:
+    """
+    Store buffered responses and NoConsent rows in a single transaction,
+    using multi-row inserts. If a row is rejected by the database (e.g. it
+    refers to a batch that doesn't exist) the whole transaction is rolled
+    back and the error is raised, so that the caller can retry the rows one
+    at a time. Returns how many of the responses were new.
+    """
+    new = 0
+    async with async_session(engine) as session:
+        for i in range(0, len(responses), INSERT_CHUNK_SIZE):
+            chunk = responses[i : i + INSERT_CHUNK_SIZE]
+            new += len(await add_responses(chunk, session))
+        for i in range(0, len(no_consent), INSERT_CHUNK_SIZE):
+            chunk = no_consent[i : i + INSERT_CHUNK_SIZE]
+            await session.exec(insert(NoConsent).values(chunk))
+        await session.commit()
+    if new:
+        cache.bump("response", "outcomes")
+    if no_consent:
+        cache.bump("noconsent")
+    return new
+
+
+async def generate_bandit(labels: List[str], engine: AsyncEngine):
     """
     Initialize our Bandit table
     """
-    with Session(engine) as session:
+    async with async_session(engine) as session:
         for label in labels:
             arm = Bandit(label=label)
             session.add(arm)
-            session.commit()
-        session.commit()
+            await session.commit()
+        await session.commit()
+    cache.bump("bandit")
 
 
-def generate_batch(
+async def generate_batch(
     labels: List[str],
     remaining: int,
     active: bool,
     pi: dict,
     params: dict,
-    engine: None | Engine,
+    engine: AsyncEngine,
 ):
     """
     Initialize our Bandit pi (% of sims each arm is max discriminatory) table
     as well as the batch table.
 
-    `params` should be a dictionary as described above in `generate_parameters`
+    `params` should be a dictionary as described above in `add_parameters`.
+    Returns the id of the new batch.
 
     E.g.
     labels = ["arm1", "arm2", "arm3", "arm4"]
     """
-    # Generate new row in the `Batch` table
-    with Session(engine) as session:
-        batch_obj = Batch(remaining=remaining, active=active)
-        session.add(batch_obj)
-        session.commit()
-        batch_id = batch_obj.id
-    # Generate new values in the `Parameters` table
-    generate_parameters(labels=labels, batch_id=batch_id, params=params, engine=engine)
-    # Generate new values in the `Pi` table
-    generate_pi(labels=labels, batch_id=batch_id, pi=pi, engine=engine)
+    async with async_session(engine) as session:
+        batch_id = await add_batch(labels, remaining, active, pi, params, session)
+        await session.commit()
+    cache.bump("batch", "parameters", "pi")
+    return batch_id
 
 
-def generate_bandit_metadata(labels: List[str], meta: dict, engine: None | Engine):
+async def generate_bandit_metadata(labels: List[str], meta: dict, engine: AsyncEngine):
     """
     Initialize our Bandit metadata table
     """
-    with Session(engine) as session:
+    async with async_session(engine) as session:
+        # Get the corresponding Bandit arms
+        arm_ids = await get_arm_ids(labels, session)
         for label in labels:
-            # Get the corresponding Bandit arm
-            arm: Bandit = session.exec(
-                select(Bandit).where(Bandit.label == label)
-            ).one()
             arm_meta = meta[label]
             ## TODO: This entire part could be abstracted to create
             ## Metadata table from an arbitrarty set of metadata
@@ -97,7 +598,7 @@ def generate_bandit_metadata(labels: List[str], meta: dict, engine: None | Engin
                 prior_trips, education, reason, origin, profession
             ):
                 metadata_obj = Metadata(
-                    arm_id=arm.id,
+                    arm_id=arm_ids[label],
                     prior_trips=trips,
                     education=ed,
                     reason=reason,
@@ -105,85 +606,22 @@ def generate_bandit_metadata(labels: List[str], meta: dict, engine: None | Engin
                     profession=prof,
                 )
                 session.add(metadata_obj)
-                session.commit()
-        # TODO: Is this last session.commit really necessary???
-        session.commit()
+        await session.commit()
+    # Make sure the metadata cache picks up the new profiles
+    cache.clear_metadata()
+    cache.bump("metadata")
 
 
-def generate_no_consent(batch_id: int, consent: bool, engine: Engine):
+async def generate_no_consent(batch_id: int, consent: bool, engine: AsyncEngine):
     """Generate a row in the NoConsent database table"""
-    with Session(engine) as session:
+    async with async_session(engine) as session:
         no_consent_obj = NoConsent(batch_id=batch_id, consent=consent)
         session.add(no_consent_obj)
-        session.commit()
-
-
-def generate_parameters(
-    labels: List[str], batch_id: int, params: dict, engine: None | Engine
-):
-    """
-    Initialize our Bandit parameters table
-
-    `params` is a dictionary with keys equal to `labels` and the values
-    being a dictionary containing "alpha" and "beta" values parameterizing
-    the beta distribution in each arm. E.g.
-    ```
-    params: {
-        "arm1": {"alpha": 1, "beta": 1},
-        "arm2": {"alpha": 1, "beta": 1},
-        "arm3": {"alpha": 1, "beta": 1},
-        "arm4": {"alpha": 1, "beta": 1}
-    }
-    ```
-    """
-    with Session(engine) as session:
-        for label in labels:
-            # Get the corresponding Bandit arm
-            arm: Bandit = session.exec(
-                select(Bandit).where(Bandit.label == label)
-            ).one()
-            arm_params = params[label]
-            ## TODO: Is there a way to make this distribution agnostic.
-            ## E.g. we could switch from Bernoulli with beta prior to
-            ## a Gaussian with a Gaussian prior and the code stays the same?
-            param_obj = Parameters(
-                arm_id=arm.id,
-                batch_id=batch_id,
-                alpha=arm_params["alpha"],
-                beta=arm_params["beta"],
-            )
-            session.add(param_obj)
-            session.commit()
-        session.commit()
+        await session.commit()
+    cache.bump("noconsent")
 
 
-def generate_pi(labels: List[str], batch_id: int, pi: dict, engine: None | Engine):
-    """
-    Initialize our Bandit Pi table
-
-    `pi` should be a dictionary where the keys are the `labels`, and the values
-    are floats indicating the % of realizations drawn from the posterior
-    distribution of each arm that the corresponding arm is the max/min
-    discriminatory context.
-
-    E.g.
-    pi = {"arm1": 0.25, "arm2": 0.5, "arm3": 0.75, "arm4": 1}
-    """
-    # Generate new values in the `Pi` table
-    with Session(engine) as session:
-        for label in labels:
-            # Get the corresponding Bandit arm
-            arm: Bandit = session.exec(
-                select(Bandit).where(Bandit.label == label)
-            ).one()
-            # Get corresponding pi value
-            arm_pi = pi[label]
-            pi_obj = Pi(batch_id=batch_id, arm_id=arm.id, pi=arm_pi)
-            session.add(pi_obj)
-            session.commit()
-
-
-def generate_response(
+async def generate_response(
     consent: bool,
     arm_id: int,
     batch_id: int,
@@ -201,11 +639,15 @@ def generate_response(
     sex: str | None,
     discriminated: bool | None,
     garbage: bool,
-    engine: None | Engine,
-):
-    """Add a user's responses (filled out survey form) to the database"""
-    with Session(engine) as session:
-        response_obj = Response(
+    engine: AsyncEngine,
+) -> bool:
+    """
+    Add a user's responses (filled out survey form) to the database. Returns
+    whether the response was new, i.e. False if the user had already
+    responded.
+    """
+    async with async_session(engine) as session:
+        response = dict(
             consent=consent,
             arm_id=arm_id,
             batch_id=batch_id,
@@ -224,166 +666,482 @@ def generate_response(
             discriminated=discriminated,
             garbage=garbage,
         )
-        session.add(response_obj)
-        session.commit()
-    return True
+        response_id = await add_response(response, session)
+        await session.commit()
+    if response_id is not None:
+        cache.bump("response", "outcomes")
+    return response_id is not None
 
 
-def get_bandit(engine) -> List[Bandit]:
-    """Retrieve a list of all bandit arms"""
-    with Session(engine) as session:
-        bandit = session.exec(select(Bandit)).all()
-        out = list()
-        for arm in bandit:
-            out.append(
-                {
-                    "arm": arm,
-                    "parameters": arm.parameters,
-                    "metadata": arm.meta,
-                    "pi": arm.pi,
-                    "responses": arm.responses,
-                }
-            )
+async def get_arm_ids(labels: List[str], session: AsyncSession) -> dict:
+    """Look up the ids of the Bandit arms with the given labels in one query"""
+    arms = await session.exec(
+        select(Bandit.label, Bandit.id).where(Bandit.label.in_(labels))
+    )
+    return dict(arms.all())
+
+
+async def get_bandit(engine: AsyncEngine) -> List[dict]:
+    """
+    Retrieve a list of all bandit arms. Each kind of related row is fetched
+    for every arm at once, so this takes five queries however many arms
+    there are.
+    """
+    statement = select(*columns(Bandit)).order_by(Bandit.id)
+    async with async_session(engine) as session:
+        bandit = (await session.exec(statement)).mappings().all()
+        ids = [arm["id"] for arm in bandit]
+        params = await group_related(Parameters, Parameters.arm_id, ids, session)
+        meta = await group_related(Metadata, Metadata.arm_id, ids, session)
+        pi = await group_related(Pi, Pi.arm_id, ids, session)
+        responses = await group_related(Response, Response.arm_id, ids, session)
+    out = list()
+    for arm in bandit:
+        out.append(
+            {
+                "arm": dict(arm),
+                "parameters": params.get(arm["id"], []),
+                "metadata": meta.get(arm["id"], []),
+                "pi": pi.get(arm["id"], []),
+                "responses": responses.get(arm["id"], []),
+            }
+        )
     return out
 
 
-def get_batch(batch_id: int, engine: Engine):
+async def get_batch(batch_id: int, engine: AsyncEngine):
     """Retrieve a specific Batch"""
-    with Session(engine) as session:
-        out = []
-        batch = session.exec(select(Batch).where(Batch.id == batch_id)).one()
+    async with async_session(engine) as session:
+        batch = (await session.exec(select(Batch).where(Batch.id == batch_id))).one()
     return batch
 
 
-def get_batches(engine):
+async def get_batches(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> List[dict]:
     """Retrieve a list of all batch values"""
-    with Session(engine) as session:
-        out = []
-        batch = session.exec(select(Batch)).all()
-        for b in batch:
-            out.append({"batch": b, "parameters": b.parameters, "pi": b.pi})
-    return out
+    return [b async for b in stream_batches(engine, after_id=after_id, limit=limit)]
 
 
-def get_current_batch(engine: Engine, deactivate: bool = False):
-    """Get the batch id for the current batch"""
+async def get_current_batch(engine: AsyncEngine, deactivate: bool = False):
+    """
+    Get the current batch, i.e. the most recent batch that is active and has
+    responses remaining. This is normally a primary key lookup through the
+    `CurrentBatch` pointer. If the pointer is missing or the batch it points
+    at has run out, the current batch is searched for and the pointer reset.
+    """
     print(f"Deactivating: {deactivate}")
-    with Session(engine) as session:
-        batches = session.exec(
-            select(Batch).where(Batch.remaining > 0).where(Batch.active == True)
-        ).all()
-        # If batch is greater than 1 then there are multiple active batches.
-        # In this case, all batches that are not the most recent (the one with...
-        # the highest value for its id) should be deactivated.
-        current_batch: Batch = max(batches, key=lambda x: x.id)
-        if len(batches) > 1 and deactivate:
-            ids = [batch.id for batch in batches]
-            for id in ids:
-                if id != current_batch.id:
-                    deactivate_batch(batch_id=id, engine=engine)
+    deactivated = 0
+    statement = (
+        select(Batch)
+        .join(CurrentBatch, CurrentBatch.batch_id == Batch.id)
+        .where(Batch.remaining > 0)
+        .where(Batch.active == True)
+    )
+    async with async_session(engine) as session:
+        current_batch = (await session.exec(statement)).first()
+        if current_batch is None:
+            statement = (
+                select(Batch)
+                .where(Batch.remaining > 0)
+                .where(Batch.active == True)
+                .order_by(Batch.id.desc())
+                .limit(1)
+            )
+            current_batch = (await session.exec(statement)).first()
+            if current_batch is not None:
+                await set_current_batch(current_batch.id, session)
+        # All active batches that are not the most recent (the one with the
+        # highest value for its id) should be deactivated
+        if current_batch is not None and deactivate:
+            statement = (
+                update(Batch)
+                .where(Batch.id < current_batch.id)
+                .where(Batch.remaining > 0)
+                .where(Batch.active == True)
+                .values(active=False)
+            )
+            deactivated = (await session.exec(statement)).rowcount
+        await session.commit()
+    if deactivated:
+        cache.bump("batch")
     return current_batch
 
 
-def get_metadata(engine):
-    """Retrieve a list of all metadata items"""
-    with Session(engine) as session:
-        metadata = session.exec(select(Metadata)).all()
-    return metadata
+async def get_ids(model, engine: AsyncEngine) -> List[int]:
+    """All the ids in a model's table, e.g. to check foreign keys against"""
+    async with async_session(engine) as session:
+        return (await session.exec(select(model.id))).all()
+
 
+async def get_metadata(engine: AsyncEngine):
+    """Retrieve a list of all metadata items (from the in-process cache)"""
+    metadata = await cache.get_metadata(engine)
+    return [dict(profile) for profile in metadata]
 
-def get_no_consent(engine: Engine):
+
+async def get_no_consent(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+):
     """Retrieves all records from the NoConsent table"""
-    with Session(engine) as session:
-        noconsent = session.exec(select(NoConsent)).all()
-    return noconsent
+    statement = paginate(select(*columns(NoConsent)), NoConsent.id, after_id, limit)
+    async with async_session(engine) as session:
+        noconsent = (await session.exec(statement)).mappings().all()
+    return [dict(record) for record in noconsent]
+
+
+async def get_outcomes(engine: AsyncEngine, batch_id: int | None = None):
+    """Retrieve the running success/failure counts, optionally for one batch"""
+    statement = select(*columns(Outcomes))
+    statement = statement.order_by(Outcomes.batch_id, Outcomes.arm_id)
+    if batch_id is not None:
+        statement = statement.where(Outcomes.batch_id == batch_id)
+    async with async_session(engine) as session:
+        outcomes = (await session.exec(statement)).mappings().all()
+    return [dict(outcome) for outcome in outcomes]
+
+
+async def get_prolific_ids(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> List[list]:
+    """
+    Retrieve the Prolific IDs that have responded as compact `[id, prolific_id]`
+    pairs, where `id` is the response id (to page through them with `after_id`)
+    """
+    statement = select(Response.id, Response.prolific_id).where(
+        Response.prolific_id != None
+    )
+    statement = paginate(statement, Response.id, after_id, limit)
+    async with async_session(engine) as session:
+        prolific_ids = (await session.exec(statement)).all()
+    return [list(row) for row in prolific_ids]
 
 
-def get_parameters(engine: Engine):
+async def get_parameters(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> List[dict]:
     """Retrieve a list of all bandit arm parameters"""
-    with Session(engine) as session:
-        params = session.exec(select(Parameters)).all()
-        out = []
-        for param in params:
-            out.append({"parameters": param, "batch": param.batch})
-    return out
+    params = stream_parameters(engine, after_id=after_id, limit=limit)
+    return [param async for param in params]
 
 
-def get_pi(engine):
+async def get_pi(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> List[dict]:
     """Retrieve a list of all pi values"""
-    with Session(engine) as session:
-        pi = session.exec(select(Pi)).all()
-        out = []
-        for p in pi:
-            out.append({"pi": p, "batch": p.batch})
-    return out
+    return [p async for p in stream_pi(engine, after_id=after_id, limit=limit)]
+
+
+async def get_response_counts(engine: AsyncEngine) -> dict:
+    """
+    Count the responses (in total, valid and garbage) and the no-consent
+    records with a single aggregate query rather than fetching the rows.
+    """
+    statement = select(
+        func.count(Response.id),
+        func.count(Response.id).filter(Response.garbage == False),
+        func.count(Response.id).filter(Response.garbage == True),
+        select(func.count(NoConsent.id)).scalar_subquery(),
+    )
+    async with async_session(engine) as session:
+        total, valid, garbage, noconsent = (await session.exec(statement)).one()
+    return {"total": total, "valid": valid, "garbage": garbage, "noconsent": noconsent}
 
 
-def get_responses(engine: None | Engine):
+async def get_responses(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+):
     """Retrieve a list of all responses"""
-    with Session(engine) as session:
-        responses = session.exec(select(Response)).all()
-    return responses
+    statement = paginate(select(*columns(Response)), Response.id, after_id, limit)
+    async with async_session(engine) as session:
+        responses = (await session.exec(statement)).mappings().all()
+    return [dict(response) for response in responses]
+
+
+async def group_related(model, key, ids: list, session: AsyncSession) -> dict:
+    """
+    Fetch the rows of `model` whose `key` column is one of `ids`, as dicts
+    grouped by their `key`
+    """
+    statement = select(*columns(model)).where(key.in_(ids)).order_by(model.id)
+    grouped = {}
+    for row in (await session.exec(statement)).mappings():
+        grouped.setdefault(row[key.name], []).append(dict(row))
+    return grouped
 
 
-def increment_batch(
-    batch_id: int, remaining: int, active: bool, maximum: bool, engine: None | Engine
+async def increment_batch(
+    batch_id: int,
+    remaining: int,
+    active: bool,
+    maximum: bool,
+    pi_method: str,
+    engine: AsyncEngine,
 ):
-    bandit = get_bandit(engine=engine)
-    # For each arm, collect successes and failures
-    labels = []
-    params = {}
-    for arm in bandit:
-        arm = arm["arm"]
-        arm_label = arm.label
-        # Construct the labels for each arm
-        labels.append(arm_label)
-        # Construct updated alpha and beta parameters for each arm
-        with Session(engine) as session:
-            arm_params = session.exec(
-                select(Parameters)
-                .where(Parameters.arm_id == arm.id)
-                .where(Parameters.batch_id == batch_id)
-            ).one()
-            arm_batch_responses = session.exec(
-                select(Response)
-                .where(Response.arm_id == arm.id)
-                .where(Response.batch_id == batch_id)
-                .where(Response.garbage != True)
-            ).all()
-            successes = 0
-            failures = 0
-            ## TODO: related to the above. Is there a way to update the
-            ## posterior distribution in a distribution-agnostic way?
-            for response in arm_batch_responses:
-                if response.discriminated is True:
-                    successes += 1
-                elif response.discriminated is False:
-                    failures += 1
-            params[arm_label] = {
-                "alpha": arm_params.alpha + successes,
-                "beta": arm_params.beta + failures,
-            }
-    # Construct updated Pi value for each arm
-    pi = draw_arms(params, max=maximum)
-    print(f"{pi}")
-    # Now update the `Batch`, `Parameters` and `Pi` tables
-    generate_batch(
-        labels=labels,
-        remaining=remaining,
-        active=active,
-        pi=pi,
-        params=params,
-        engine=engine,
-    )
+    """Create the batch that follows `batch_id` (see `advance_batch`)"""
+    async with async_session(engine) as session:
+        new_batch_id, _ = await advance_batch(
+            batch_id, remaining, active, maximum, pi_method, session
+        )
+        await session.commit()
+    cache.bump("batch", "parameters", "pi")
+    # Arm samplers for the earlier batches won't be needed anymore
+    cache.roll_forward(new_batch_id)
 
 
-def is_duplicate_id(prolific_id: str, engine: Engine) -> bool:
+async def is_duplicate_id(prolific_id: str, engine: AsyncEngine) -> bool:
     """Checks if a prolific ID has already submitted a response"""
-    with Session(engine) as session:
-        resp_obj = session.exec(
-            select(Response).where(Response.prolific_id == prolific_id)
-        ).all()
-        if len(resp_obj) > 0:
-            return True
+    statement = select(exists().where(Response.prolific_id == prolific_id))
+    async with async_session(engine) as session:
+        return (await session.exec(statement)).one()
+
+
+def paginate(statement, id_column, after_id: int | None, limit: int | None):
+    """
+    Apply keyset pagination to a query: rows are ordered by `id_column` and
+    only those after `after_id` are returned, at most `limit` of them.
+    """
+    statement = statement.order_by(id_column)
+    if after_id is not None:
+        statement = statement.where(id_column > after_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+async def record_submission(
+    submission_id: str | None, outcome: dict, session: AsyncSession
+):
+    """Record the outcome of a claimed submission (see `claim_submission`)"""
+    if submission_id is None:
+        return
+    statement = (
+        update(Submission).where(Submission.id == submission_id).values(**outcome)
+    )
+    await session.exec(statement)
+
+
+async def set_current_batch(batch_id: int, session: AsyncSession):
+    """Point the `CurrentBatch` pointer at `batch_id`"""
+    statement = insert(CurrentBatch).values(id=1, batch_id=batch_id)
+    statement = statement.on_conflict_do_update(
+        index_elements=[CurrentBatch.id], set_={"batch_id": batch_id}
+    )
+    await session.exec(statement)
+
+
+@asynccontextmanager
+async def snapshot(engine: AsyncEngine) -> AsyncIterator[AsyncConnection]:
+    """
+    A connection whose queries all read from the same snapshot of the
+    database, in a read-only (REPEATABLE READ) transaction. Like any reader
+    under MVCC it never blocks writers, nor do writers block it.
+    """
+    async with engine.connect() as connection:
+        connection = await connection.execution_options(
+            isolation_level="REPEATABLE READ", postgresql_readonly=True
+        )
+        async with connection.begin():
+            yield connection
+
+
+def split_row(row: tuple, *models) -> List[dict]:
+    """
+    Split a row that selected `columns(model)` for each of `models` in turn
+    into one dict per model
+    """
+    out = []
+    start = 0
+    for model in models:
+        names = model.__table__.columns.keys()
+        out.append(dict(zip(names, row[start : start + len(names)])))
+        start += len(names)
+    return out
+
+
+async def stream_batches(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> AsyncIterator[dict]:
+    """
+    Yield batch values one at a time from a server-side cursor. The batches'
+    parameters and pi values are fetched alongside each chunk of batches.
+    """
+    statement = paginate(select(*columns(Batch)), Batch.id, after_id, limit)
+    async with async_session(engine) as session:
+        batches = await session.stream(
+            statement.execution_options(yield_per=STREAM_CHUNK_SIZE)
+        )
+        async for chunk in batches.mappings().partitions():
+            ids = [b["id"] for b in chunk]
+            params = await group_related(Parameters, Parameters.batch_id, ids, session)
+            pi = await group_related(Pi, Pi.batch_id, ids, session)
+            for b in chunk:
+                yield {
+                    "batch": dict(b),
+                    "parameters": params.get(b["id"], []),
+                    "pi": pi.get(b["id"], []),
+                }
+
+
+async def stream_no_consent(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> AsyncIterator[dict]:
+    """Yield NoConsent records one at a time from a server-side cursor"""
+    statement = paginate(select(*columns(NoConsent)), NoConsent.id, after_id, limit)
+    async with async_session(engine) as session:
+        noconsent = await session.stream(
+            statement.execution_options(yield_per=STREAM_CHUNK_SIZE)
+        )
+        async for record in noconsent.mappings():
+            yield dict(record)
+
+
+async def stream_parameters(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> AsyncIterator[dict]:
+    """Yield bandit arm parameters one at a time from a server-side cursor"""
+    statement = select(*columns(Parameters), *columns(Batch)).join(Batch)
+    statement = paginate(statement, Parameters.id, after_id, limit)
+    async with async_session(engine) as session:
+        params = await session.stream(
+            statement.execution_options(yield_per=STREAM_CHUNK_SIZE)
+        )
+        async for row in params:
+            param, batch = split_row(row, Parameters, Batch)
+            yield {"parameters": param, "batch": batch}
+
+
+async def stream_pi(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> AsyncIterator[dict]:
+    """Yield pi values one at a time from a server-side cursor"""
+    statement = select(*columns(Pi), *columns(Batch)).join(Batch)
+    statement = paginate(statement, Pi.id, after_id, limit)
+    async with async_session(engine) as session:
+        pi = await session.stream(
+            statement.execution_options(yield_per=STREAM_CHUNK_SIZE)
+        )
+        async for row in pi:
+            p, batch = split_row(row, Pi, Batch)
+            yield {"pi": p, "batch": batch}
+
+
+async def stream_responses(
+    engine: AsyncEngine, after_id: int | None = None, limit: int | None = None
+) -> AsyncIterator[dict]:
+    """Yield responses one at a time from a server-side cursor"""
+    statement = paginate(select(*columns(Response)), Response.id, after_id, limit)
+    async with async_session(engine) as session:
+        responses = await session.stream(
+            statement.execution_options(yield_per=STREAM_CHUNK_SIZE)
+        )
+        async for response in responses.mappings():
+            yield dict(response)
+
+
+async def submit(
+    prolific_id: str | None,
+    response: ResponseJSON | None,
+    noconsent: NoConsentJSON | None,
+    batch_size: int | None,
+    maximum: bool | None,
+    warmup_n: float,
+    study_max_n: float,
+    stoppage_threshold: float,
+    pi_method: str,
+    engine: AsyncEngine,
+    submission_id: str | None = None,
+) -> dict:
+    """
+    Handle the logistics of a participant's submission in a single
+    transaction. If a submission with the same `submission_id` was handled
+    before, its outcome is returned again and nothing else happens. If the
+    individual has already submitted a response, nothing happens. Otherwise `noconsent` is stored in the NoConsent table or, if
+    it's None, `response` is stored in the Responses table. Once the warm-up
+    phase is over a valid response counts against its batch, and the batch is
+    rolled over when it runs out. Returns whether the response was a
+    duplicate, the id of the new batch (if one was created), whether the
+    Prolific study should be paused, and where the participant should be
+    redirected.
+    """
+    outcome = {
+        "duplicate": False,
+        "batch_id": None,
+        "pause": False,
+        "redirect": "valid" if noconsent is None else "noconsent",
+    }
+    # The tables this submission changes
+    changed = ["response", "outcomes"] if noconsent is None else ["noconsent"]
+    async with async_session(engine) as session:
+        if submission_id is not None:
+            recorded = await claim_submission(submission_id, session)
+            if recorded is not None:
+                return recorded
+        # If the response is a duplicate we just want to do nothing
+        if noconsent is not None:
+            if prolific_id is not None:
+                statement = select(Response.id).where(
+                    Response.prolific_id == prolific_id
+                )
+                duplicate = (await session.exec(statement.limit(1))).first()
+                outcome["duplicate"] = duplicate is not None
+            if not outcome["duplicate"]:
+                no_consent_obj = NoConsent(
+                    batch_id=noconsent.batch_id, consent=noconsent.consent
+                )
+                session.add(no_consent_obj)
+                await session.flush()
         else:
-            return False
+            response_id = await add_response(response.model_dump(), session)
+            outcome["duplicate"] = response_id is None
+        if outcome["duplicate"]:
+            await record_submission(submission_id, outcome, session)
+            await session.commit()
+            return outcome
+        num_responses = (await session.exec(select(func.count(Response.id)))).one()
+        # Update batches and corresponding parameters if the form is valid
+        # and if we have ended the warm-up phase of receiving responses
+        if noconsent is None and not response.garbage and num_responses > warmup_n:
+            # Lock the batch so that concurrent submissions decrement it (and
+            # roll it over) one at a time. The response's foreign key check
+            # already holds a KEY SHARE lock on the batch, which a plain FOR
+            # UPDATE would conflict with (and deadlock against other
+            # submissions), so take the weaker FOR NO KEY UPDATE lock.
+            statement = (
+                select(Batch)
+                .where(Batch.id == response.batch_id)
+                .with_for_update(key_share=True)
+            )
+            batch_obj = (await session.exec(statement)).one()
+            ready_to_update = batch_obj.remaining <= 1
+            batch_is_active = batch_obj.active
+            batch_obj.remaining = batch_obj.remaining - 1
+            batch_obj.active = not ready_to_update
+            session.add(batch_obj)
+            changed.append("batch")
+            if ready_to_update:
+                await clear_current_batch(batch_obj.id, session)
+            if ready_to_update and batch_is_active:
+                new_batch_id, pi = await advance_batch(
+                    batch_obj.id, batch_size, True, maximum, pi_method, session
+                )
+                outcome["batch_id"] = new_batch_id
+                changed.extend(["parameters", "pi"])
+                # Check if any of the new arm pi values exceed stoppage
+                # threshold. The stored pi values are cumulative.
+                cumulative = sorted(pi.values())
+                pi_vals = [b - a for a, b in zip([0] + cumulative[:-1], cumulative)]
+                print(f"Current pi vals: {pi_vals}")
+                if any([x >= stoppage_threshold for x in pi_vals]):
+                    outcome["pause"] = True
+        # If we have exceeded the max number of survey responses, pause the
+        # Prolific study
+        if num_responses >= study_max_n:
+            outcome["pause"] = True
+        await record_submission(submission_id, outcome, session)
+        await session.commit()
+    cache.bump(*changed)
+    if outcome["batch_id"] is not None:
+        # Arm samplers for the earlier batches won't be needed anymore
+        cache.roll_forward(outcome["batch_id"])
+    return outcome
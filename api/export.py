@@ -0,0 +1,123 @@
+import asyncio
+import io
+from db import columns, export_csv, export_rows
+from sqlalchemy import Boolean, Float, Integer, String, TypeDecorator
+from sqlalchemy.ext.asyncio import AsyncEngine
+from tables import Batch, NoConsent, Parameters, Pi, Response
+from typing import AsyncIterator, List
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+"""
+This script exports whole tables (see `GET /export/{table}`) for analysis,
+which is much faster and lighter than rebuilding them from the JSON
+endpoints.
+
+Tables can be exported as CSV, straight from Postgres' `COPY ... TO STDOUT`,
+or, if pyarrow is installed, as an Arrow IPC stream or a Parquet file, built
+chunk by chunk from a server-side cursor. Either way the table is streamed
+to the client as it's read, from a consistent read-only snapshot (see
+`db.snapshot`), so exports never hold a whole table in memory or block the
+participants' writes.
+"""
+
+# The tables that can be exported, by the name they're exported as
+EXPORTS = {
+    "responses": Response,
+    "noconsent": NoConsent,
+    "batches": Batch,
+    "parameters": Parameters,
+    "pi": Pi,
+}
+
+# The media type of each export format. Arrow and Parquet need pyarrow.
+MEDIA_TYPES = {"csv": "text/csv"}
+if pyarrow is not None:
+    MEDIA_TYPES["arrow"] = "application/vnd.apache.arrow.stream"
+    MEDIA_TYPES["parquet"] = "application/vnd.apache.parquet"
+
+# The Arrow type of each type of column the tables have
+if pyarrow is not None:
+    ARROW_TYPES = [
+        (Boolean, pyarrow.bool_()),
+        (Float, pyarrow.float64()),
+        (Integer, pyarrow.int64()),
+        (String, pyarrow.string()),
+    ]
+
+
+class ChunkSink(io.RawIOBase):
+    """A write-only file that hands out whatever was written since last time"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        """Everything written since the last call"""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema(model) -> "pyarrow.Schema":
+    """The Arrow schema of a model's table"""
+    return pyarrow.schema(
+        [pyarrow.field(c.name, arrow_type(c.type), c.nullable) for c in columns(model)]
+    )
+
+
+def arrow_type(column_type) -> "pyarrow.DataType":
+    """The Arrow type that a column's values are exported as"""
+    if isinstance(column_type, TypeDecorator):
+        # E.g. SQLModel's string columns, which wrap a plain VARCHAR
+        column_type = column_type.impl
+    for sql_type, arrow_type in ARROW_TYPES:
+        if isinstance(column_type, sql_type):
+            return arrow_type
+    raise TypeError(f"Can't export columns of type {column_type}")
+
+
+async def export_arrow(model, engine: AsyncEngine, parquet: bool) -> AsyncIterator:
+    """
+    Yield a model's whole table as an Arrow IPC stream or, if `parquet`, a
+    Parquet file, with one record batch (or row group) per chunk of rows
+    """
+    schema = arrow_schema(model)
+    sink = ChunkSink()
+    if parquet:
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    async for rows in export_rows(model, engine):
+        await asyncio.to_thread(write_rows, writer, schema, rows)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_table(model, format: str, engine: AsyncEngine) -> AsyncIterator[bytes]:
+    """Stream a model's whole table in `format` (see `MEDIA_TYPES`)"""
+    if format == "csv":
+        return export_csv(model, engine)
+    return export_arrow(model, engine, parquet=format == "parquet")
+
+
+def write_rows(writer, schema: "pyarrow.Schema", rows: List[tuple]):
+    """Write a chunk of rows to an Arrow or Parquet writer, column by column"""
+    values = list(zip(*rows))
+    arrays = [
+        pyarrow.array(column, type=field.type) for column, field in zip(values, schema)
+    ]
+    writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=schema))
@@ -0,0 +1,127 @@
+import asyncio
+import csv
+import io
+import numpy as np
+import orjson
+from db import copy_responses, get_ids
+from pydantic import TypeAdapter, ValidationError
+from response_models import ResponseJSON
+from sqlalchemy.ext.asyncio import AsyncEngine
+from tables import Bandit, Batch
+from typing import List
+
+try:
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+"""
+This script loads responses in bulk (see `POST /responses/bulk`), e.g. for
+backfills, migrations from earlier studies and load tests.
+
+The records can be sent as newline-delimited JSON, CSV (with a header row
+naming the `ResponseJSON` fields; empty cells are read as nulls) or, if
+pyarrow is installed, an Arrow IPC stream. They're validated all at once:
+pydantic checks the whole list in a single call and the foreign keys are
+checked with numpy. The valid records are then loaded with COPY (see
+`db.copy_responses`).
+"""
+
+# The media types that responses can be sent as
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+ARROW = "application/vnd.apache.arrow.stream"
+
+# Validates a list of records as responses
+responses_adapter = TypeAdapter(List[ResponseJSON])
+
+
+def dedupe(responses: dict) -> dict:
+    """Keep only the first of the responses that share a Prolific ID"""
+    seen = set()
+    unique = {}
+    for index, response in responses.items():
+        prolific_id = response["prolific_id"]
+        if prolific_id is not None:
+            if prolific_id in seen:
+                continue
+            seen.add(prolific_id)
+        unique[index] = response
+    return unique
+
+
+async def ingest_responses(records: List[dict], engine: AsyncEngine) -> dict:
+    """
+    Validate `records` as responses and store the valid ones. Returns each
+    record's new response id (None if it was invalid or a duplicate) and the
+    validation errors of the invalid ones, by position.
+    """
+    batch_ids = await get_ids(Batch, engine)
+    arm_ids = await get_ids(Bandit, engine)
+    valid, errors = await asyncio.to_thread(
+        validate_responses, records, batch_ids, arm_ids
+    )
+    valid = dedupe(valid)
+    new = await copy_responses(list(valid.values()), engine)
+    ids = [None] * len(records)
+    for index, response_id in zip(valid.keys(), new):
+        ids[index] = response_id
+    return {"ids": ids, "errors": errors}
+
+
+def parse_arrow(body: bytes) -> List[dict]:
+    """Read records from an Arrow IPC stream"""
+    return pyarrow.ipc.open_stream(body).read_all().to_pylist()
+
+
+def parse_csv(body: bytes) -> List[dict]:
+    """Read records from CSV with a header row. Empty cells become None."""
+    rows = csv.DictReader(io.StringIO(body.decode()))
+    return [{k: (v if v != "" else None) for k, v in row.items()} for row in rows]
+
+
+def parse_ndjson(body: bytes) -> List[dict]:
+    """Read records from newline-delimited JSON, skipping blank lines"""
+    return [orjson.loads(line) for line in body.splitlines() if line.strip()]
+
+
+# How to read the records for each supported media type
+PARSERS = {NDJSON: parse_ndjson, CSV: parse_csv}
+if pyarrow is not None:
+    PARSERS[ARROW] = parse_arrow
+
+
+def validate_responses(
+    records: List[dict], batch_ids: List[int], arm_ids: List[int]
+) -> tuple:
+    """
+    Validate `records` as responses. Returns the valid ones as dicts, keyed by
+    their position in `records`, and a list of the errors in the others.
+    """
+    problems = {}
+    try:
+        responses = responses_adapter.validate_python(records)
+        indices = list(range(len(records)))
+    except ValidationError as error:
+        for e in error.errors(include_url=False):
+            index, *field = e["loc"]
+            message = e["msg"] if not field else f"{field[0]}: {e['msg']}"
+            problems.setdefault(index, []).append(message)
+        indices = [i for i in range(len(records)) if i not in problems]
+        responses = responses_adapter.validate_python([records[i] for i in indices])
+    responses = responses_adapter.dump_python(responses)
+    # Check the foreign keys of every response at once
+    n = len(responses)
+    arms = np.fromiter((r["arm_id"] for r in responses), dtype=np.int64, count=n)
+    batches = np.fromiter((r["batch_id"] for r in responses), dtype=np.int64, count=n)
+    for i in np.flatnonzero(~np.isin(arms, arm_ids)):
+        problems.setdefault(indices[i], []).append("arm_id: No such arm")
+    for i in np.flatnonzero(~np.isin(batches, batch_ids)):
+        problems.setdefault(indices[i], []).append("batch_id: No such batch")
+    valid = {
+        index: response
+        for index, response in zip(indices, responses)
+        if index not in problems
+    }
+    errors = [{"row": k, "errors": v} for k, v in sorted(problems.items())]
+    return valid, errors
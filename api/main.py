@@ -1,4 +1,10 @@
-from connect import engine
+import asyncio
+import cache
+import orjson
+import os
+from buffer import WRITE_BEHIND, WRITE_BEHIND_JOURNAL, WriteBuffer
+from connect import async_engine
+from contextlib import asynccontextmanager
 from db import (
     decrement_batch,
     generate_bandit,
@@ -12,30 +18,135 @@ from db import (
     get_current_batch,
     get_metadata,
     get_no_consent,
+    get_outcomes,
     get_parameters,
     get_pi,
+    get_prolific_ids,
+    get_response_counts,
     get_responses,
     increment_batch,
     is_duplicate_id,
+    stream_batches,
+    stream_no_consent,
+    stream_parameters,
+    stream_pi,
+    stream_responses,
+    submit,
+)
+from export import EXPORTS, MEDIA_TYPES, export_table
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from ingest import NDJSON, PARSERS, ingest_responses
+from randomize import PI_METHODS, html_format, randomize
+from response_models import (
+    BanditJSON,
+    BatchJSON,
+    NoConsentJSON,
+    ResponseJSON,
+    SubmissionJSON,
 )
-from fastapi import FastAPI
-from randomize import html_format, randomize
-from response_models import BanditJSON, BatchJSON, NoConsentJSON, ResponseJSON
 
 """
 This script creates the API and defines all the available endpoints.
 The code for each endpoint calls the functions in `/api/db.py`. These
 functions do the actual grunt work. So to understand what happens for each
 endpoint, look at the corresponding functions in `db.py`.
+
+Endpoints are `async` and run their queries through the async engine, so
+they never block the event loop.
+
+The list endpoints take `after_id`/`limit` for keyset pagination (pass the
+last `id` you received as `after_id` to get the next page) and `stream=true`
+to receive the rows as newline-delimited JSON instead of a single array.
+The bulk read endpoints get their rows as plain dicts and hand them straight
+to orjson, skipping FastAPI's (much slower) `jsonable_encoder`.
+
+The read endpoints that clients poll send an `ETag` derived from the version
+counters of the tables they read (see `cache.py`). A client that sends it
+back in `If-None-Match` gets an empty 304 until one of those tables changes.
+
+Whole tables can be exported as CSV, Arrow or Parquet from `/export/{table}`
+(see `export.py`).
+
+With `WRITE_BEHIND` set, posted responses and NoConsent rows are buffered and
+written to the database in batches (see `buffer.py`).
 """
 
-# Create the API
-api = FastAPI()
+env_vars = os.environ
+
+# When to start updating batches and when to stop the study. These come from
+# the environment (the same `.env` as the UI's) rather than from clients.
+STOPPAGE_THRESHOLD = float(env_vars["STOPPAGE_THRESHOLD"])
+STUDY_MAX_N = float(env_vars["STUDY_MAX_N"])
+WARMUP_N = float(env_vars["WARMUP_N"])
+
+# How the Pi values of each new batch are computed (see `draw_arms`):
+# "exact", "simulate" or "adaptive"
+PI_METHOD = env_vars.get("PI_METHOD", "exact")
+if PI_METHOD not in PI_METHODS:
+    raise ValueError(f"Invalid PI_METHOD: {PI_METHOD}")
+
+# Response bodies smaller than this (in bytes) aren't worth compressing
+GZIP_MINIMUM_SIZE = 1000
+
+# Buffers posted responses when the API runs in write-behind mode
+if WRITE_BEHIND is not None and WRITE_BEHIND:
+    write_buffer = WriteBuffer(WRITE_BEHIND_JOURNAL, async_engine)
+else:
+    write_buffer = None
+
+
+@asynccontextmanager
+async def lifespan(api: FastAPI):
+    """Run the write-behind buffer (if any) for as long as the API is up"""
+    if write_buffer is not None:
+        await write_buffer.start()
+    yield
+    if write_buffer is not None:
+        await write_buffer.stop()
+
+
+# Create the API. Responses are serialized with orjson and gzip-compressed
+# for clients that accept it.
+api = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+api.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+
+async def ndjson(rows):
+    """Serialize an async iterator of rows as newline-delimited JSON"""
+    async for row in rows:
+        yield orjson.dumps(row) + b"\n"
+
+
+def ndjson_response(rows, etag: str | None = None) -> StreamingResponse:
+    """Stream rows to the client as newline-delimited JSON"""
+    headers = None if etag is None else {"ETag": etag}
+    return StreamingResponse(
+        ndjson(rows), media_type="application/x-ndjson", headers=headers
+    )
+
+
+def fresh(request: Request, etag: str) -> bool:
+    """
+    Whether the client's `If-None-Match` says it already has `etag`. ETags
+    are compared weakly, i.e. ignoring any `W/` prefix.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags or "*" in tags
+
+
+def not_modified(etag: str) -> Response:
+    """Tell the client that its copy of the data (tagged `etag`) is current"""
+    return Response(status_code=304, headers={"ETag": etag})
 
 
 # Base endpoint to check if it's alive.
 @api.get("/")
-def root():
+async def root():
     return "Welcome to our adaptive experiment!"
 
 
@@ -44,22 +155,71 @@ def root():
 
 # Endpoint to retrieve all the responses
 @api.get("/responses")
-def responses():
-    responses = get_responses(engine)
-    return responses
+async def responses(
+    request: Request,
+    after_id: int | None = None,
+    limit: int | None = Query(default=None, ge=1),
+    stream: bool = False,
+):
+    etag = cache.etag("response")
+    if fresh(request, etag):
+        return not_modified(etag)
+    if stream:
+        return ndjson_response(stream_responses(async_engine, after_id, limit), etag)
+    responses = await get_responses(async_engine, after_id, limit)
+    return ORJSONResponse(responses, headers={"ETag": etag})
+
+
+# Endpoint to count the responses (total, valid, garbage and no-consent)
+@api.get("/responses/count")
+async def response_counts(request: Request):
+    etag = cache.etag("response", "noconsent")
+    if fresh(request, etag):
+        return not_modified(etag)
+    counts = await get_response_counts(async_engine)
+    return ORJSONResponse(counts, headers={"ETag": etag})
+
+
+# Endpoint to retrieve the Prolific IDs that have responded, as compact
+# `[response id, prolific id]` pairs (see `ui/utils_db.py`)
+@api.get("/responses/prolific_ids")
+async def prolific_ids(
+    request: Request,
+    after_id: int | None = None,
+    limit: int | None = Query(default=None, ge=1),
+):
+    etag = cache.etag("response")
+    if fresh(request, etag):
+        return not_modified(etag)
+    prolific_ids = await get_prolific_ids(async_engine, after_id, limit)
+    return ORJSONResponse(prolific_ids, headers={"ETag": etag})
 
 
 # Endpoint to retrieve all records from the NoConsent table
 @api.get("/responses/noconsent")
-def no_consent():
-    noconsent = get_no_consent(engine)
-    return noconsent
-
-
-# Endpoint to send response data to
+async def no_consent(
+    request: Request,
+    after_id: int | None = None,
+    limit: int | None = Query(default=None, ge=1),
+    stream: bool = False,
+):
+    etag = cache.etag("noconsent")
+    if fresh(request, etag):
+        return not_modified(etag)
+    if stream:
+        return ndjson_response(stream_no_consent(async_engine, after_id, limit), etag)
+    noconsent = await get_no_consent(async_engine, after_id, limit)
+    return ORJSONResponse(noconsent, headers={"ETag": etag})
+
+
+# Endpoint to send response data to. Returns whether the response was new,
+# i.e. False if the user had already responded. In write-behind mode only
+# the buffered responses are checked (see `buffer.py`).
 @api.post("/responses")
-def response_gen(response: ResponseJSON):
-    generate_response(
+async def response_gen(response: ResponseJSON):
+    if write_buffer is not None:
+        return await write_buffer.add_response(response.model_dump())
+    new = await generate_response(
         consent=response.consent,
         arm_id=response.arm_id,
         batch_id=response.batch_id,
@@ -77,24 +237,67 @@ def response_gen(response: ResponseJSON):
         sex=response.sex,
         discriminated=response.discriminated,
         garbage=response.garbage,
-        engine=engine,
+        engine=async_engine,
     )
-    return True
+    return new
+
+
+# Endpoint to load many responses at once, sent as newline-delimited JSON,
+# CSV or (if pyarrow is installed) an Arrow IPC stream; see `ingest.py`.
+# Returns each record's new id (null if it was invalid or a duplicate) along
+# with the errors of the invalid records.
+@api.post("/responses/bulk")
+async def response_bulk(request: Request):
+    media_type = request.headers.get("content-type", NDJSON).split(";")[0].strip()
+    if media_type not in PARSERS:
+        raise HTTPException(415, f"Expected one of: {', '.join(PARSERS)}")
+    try:
+        body = await request.body()
+        records = await asyncio.to_thread(PARSERS[media_type], body)
+    except ValueError as error:
+        raise HTTPException(400, f"Couldn't read the records: {error}")
+    return await ingest_responses(records, async_engine)
 
 
 # Endpoint to send responses with no consent to
 @api.post("/responses/noconsent")
-def no_consent_gen(response: NoConsentJSON):
-    generate_no_consent(
-        batch_id=response.batch_id, consent=response.consent, engine=engine
+async def no_consent_gen(response: NoConsentJSON):
+    if write_buffer is not None:
+        await write_buffer.add_no_consent(response.model_dump())
+        return True
+    await generate_no_consent(
+        batch_id=response.batch_id, consent=response.consent, engine=async_engine
     )
     return True
 
 
 # Endpoint for checking if user has already submitted response
 @api.post("/responses/duplicated")
-def is_duplicate(prolific_id: str):
-    return is_duplicate_id(prolific_id, engine)
+async def is_duplicate(prolific_id: str):
+    if write_buffer is not None and write_buffer.contains(prolific_id):
+        return True
+    return await is_duplicate_id(prolific_id, async_engine)
+
+
+# Endpoint to submit a participant's response form. The duplicate check,
+# insert, batch update and stoppage check all happen in one transaction. A
+# submission resent with the same `submission_id` gets its first outcome back.
+@api.post("/submit")
+async def submission(submission: SubmissionJSON):
+    outcome = await submit(
+        prolific_id=submission.prolific_id,
+        response=submission.response,
+        noconsent=submission.noconsent,
+        batch_size=submission.batch_size,
+        maximum=submission.maximum,
+        warmup_n=WARMUP_N,
+        study_max_n=STUDY_MAX_N,
+        stoppage_threshold=STOPPAGE_THRESHOLD,
+        pi_method=PI_METHOD,
+        engine=async_engine,
+        submission_id=submission.submission_id,
+    )
+    return outcome
 
 
 # Endpoints for working with the Bandit table -----------------------------
@@ -102,31 +305,36 @@ def is_duplicate(prolific_id: str):
 
 # Endpoint to retrieve the Bandit table
 @api.get("/bandit")
-def bandit():
-    bandit = get_bandit(engine)
-    return bandit
+async def bandit(request: Request):
+    etag = cache.etag("bandit", "parameters", "metadata", "pi", "response")
+    if fresh(request, etag):
+        return not_modified(etag)
+    bandit = await get_bandit(async_engine)
+    return ORJSONResponse(bandit, headers={"ETag": etag})
 
 
 # Endpoint to add the Bandit table
 @api.post("/bandit")
-def bandit_gen(bandit: BanditJSON):
+async def bandit_gen(bandit: BanditJSON):
     bandit_labels = bandit.labels
     bandit_params = bandit.params
     bandit_meta = bandit.meta
     bandit_pi = bandit.pi
     bandit_batch = bandit.batch
     # This generates a Bandit instance with as many arms as provided
-    generate_bandit(labels=bandit_labels, engine=engine)
+    await generate_bandit(labels=bandit_labels, engine=async_engine)
     # This generates the metadata table with metadata for each bandit arm
-    generate_bandit_metadata(labels=bandit_labels, meta=bandit_meta, engine=engine)
+    await generate_bandit_metadata(
+        labels=bandit_labels, meta=bandit_meta, engine=async_engine
+    )
     # Generate the `Batch`, `Parameters`, and `Pi` tables
-    generate_batch(
+    await generate_batch(
         labels=bandit_labels,
         remaining=bandit_batch["remaining"],
         active=bandit_batch["active"],
         pi=bandit_pi,
         params=bandit_params,
-        engine=engine,
+        engine=async_engine,
     )
     return True
 
@@ -136,9 +344,19 @@ def bandit_gen(bandit: BanditJSON):
 
 # Endpoint to retrieve the parameters
 @api.get("/bandit/parameters")
-def bandit_parameters():
-    params = get_parameters(engine)
-    return params
+async def bandit_parameters(
+    request: Request,
+    after_id: int | None = None,
+    limit: int | None = Query(default=None, ge=1),
+    stream: bool = False,
+):
+    etag = cache.etag("parameters", "batch")
+    if fresh(request, etag):
+        return not_modified(etag)
+    if stream:
+        return ndjson_response(stream_parameters(async_engine, after_id, limit), etag)
+    params = await get_parameters(async_engine, after_id, limit)
+    return ORJSONResponse(params, headers={"ETag": etag})
 
 
 # Endpoints for working with the Metadata table ---------------------------
@@ -146,9 +364,25 @@ def bandit_parameters():
 
 # Endpoint to retrieve the metadata
 @api.get("/bandit/metadata")
-def bandit_metadata():
-    metadata = get_metadata(engine)
-    return metadata
+async def bandit_metadata(request: Request):
+    etag = cache.etag("metadata")
+    if fresh(request, etag):
+        return not_modified(etag)
+    metadata = await get_metadata(async_engine)
+    return ORJSONResponse(metadata, headers={"ETag": etag})
+
+
+# Endpoints for working with the Outcomes table ---------------------------
+
+
+# Endpoint to retrieve the running success/failure counts for each arm
+@api.get("/bandit/outcomes")
+async def bandit_outcomes(request: Request, batch_id: int | None = None):
+    etag = cache.etag("outcomes")
+    if fresh(request, etag):
+        return not_modified(etag)
+    outcomes = await get_outcomes(async_engine, batch_id)
+    return ORJSONResponse(outcomes, headers={"ETag": etag})
 
 
 # Endpoints for working with the Pi table ---------------------------------
@@ -156,9 +390,19 @@ def bandit_metadata():
 
 # Endpoint to retrieve the Pi table
 @api.get("/bandit/pi")
-def bandit_pi():
-    pi = get_pi(engine)
-    return pi
+async def bandit_pi(
+    request: Request,
+    after_id: int | None = None,
+    limit: int | None = Query(default=None, ge=1),
+    stream: bool = False,
+):
+    etag = cache.etag("pi", "batch")
+    if fresh(request, etag):
+        return not_modified(etag)
+    if stream:
+        return ndjson_response(stream_pi(async_engine, after_id, limit), etag)
+    pi = await get_pi(async_engine, after_id, limit)
+    return ORJSONResponse(pi, headers={"ETag": etag})
 
 
 # Endpoints for working with Batches --------------------------------------
@@ -166,44 +410,79 @@ def bandit_pi():
 
 # Endpoint to retrieve the Batch table
 @api.get("/bandit/batch")
-def bandit_batches(batch_id: int | None = None):
+async def bandit_batches(
+    request: Request,
+    batch_id: int | None = None,
+    after_id: int | None = None,
+    limit: int | None = Query(default=None, ge=1),
+    stream: bool = False,
+):
     if batch_id is not None:
-        batch = get_batch(batch_id, engine)
-    else:
-        batch = get_batches(engine)
-    return batch
+        batch = await get_batch(batch_id, async_engine)
+        return batch
+    etag = cache.etag("batch", "parameters", "pi")
+    if fresh(request, etag):
+        return not_modified(etag)
+    if stream:
+        return ndjson_response(stream_batches(async_engine, after_id, limit), etag)
+    batches = await get_batches(async_engine, after_id, limit)
+    return ORJSONResponse(batches, headers={"ETag": etag})
 
 
 # Endpoint to get the current Batch object
 @api.get("/bandit/batch/current")
-def cur_batch(deactivate: bool = False):
-    batch = get_current_batch(engine, deactivate)
+async def cur_batch(deactivate: bool = False):
+    batch = await get_current_batch(async_engine, deactivate)
     return batch
 
 
 # Endpoint to get randomized content for within-context comparison
 @api.get("/randomize")
-def randomize_context(batch_id: int):
-    context_data = randomize(batch_id=batch_id, engine=engine)
-    html_formatted_context = html_format(context_data)
+async def randomize_context(batch_id: int):
+    context_data, rows = await randomize(batch_id=batch_id, engine=async_engine)
+    html_formatted_context = html_format(context_data, rows)
     return html_formatted_context
 
 
 # Endpoint to increment the Batch (including Parameters and Pi)
 @api.post("/bandit/batch")
-def increment_bandit_batch(batch: BatchJSON):
+async def increment_bandit_batch(batch: BatchJSON):
     batch_id = batch.batch_id
     batch_remaining = batch.remaining
     batch_active = batch.active
     batch_max = batch.maximum
-    increment_batch(
-        batch_id, batch_remaining, batch_active, maximum=batch_max, engine=engine
+    await increment_batch(
+        batch_id,
+        batch_remaining,
+        batch_active,
+        maximum=batch_max,
+        pi_method=PI_METHOD,
+        engine=async_engine,
     )
     return True
 
 
 # Endpoint to decrement the `remaining` parameter of a batch
 @api.post("/bandit/batch/decrement")
-def decrement_batch_id(batch_id: int, active: bool = True):
-    decrement_batch(batch_id, active, engine)
+async def decrement_batch_id(batch_id: int, active: bool = True):
+    await decrement_batch(batch_id, active, async_engine)
     return True
+
+
+# Endpoints for exporting tables ------------------------------------------
+
+
+# Endpoint to export a whole table (responses, noconsent, batches, parameters
+# or pi) as `format` (csv, or arrow/parquet if pyarrow is installed). The
+# table is streamed from a consistent read-only snapshot.
+@api.get("/export/{table}")
+async def export(table: str, format: str = "csv"):
+    if table not in EXPORTS:
+        raise HTTPException(404, f"Expected one of: {', '.join(EXPORTS)}")
+    if format not in MEDIA_TYPES:
+        raise HTTPException(400, f"Expected one of: {', '.join(MEDIA_TYPES)}")
+    return StreamingResponse(
+        export_table(EXPORTS[table], format, async_engine),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
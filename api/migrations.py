@@ -0,0 +1,137 @@
+from sqlalchemy import Engine, text
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from tables import SchemaVersion
+
+"""
+This script brings the schema of an existing database up to date with
+`tables.py`, by applying the numbered migrations below that it hasn't had
+yet. Each applied migration is recorded in the `schema_version` table.
+
+`create_all` makes any tables that are missing, with all their indexes, but
+it never touches tables that already exist. So a migration is needed whenever
+an index (or other change) is added to an existing table. Indexes are built
+with `CREATE INDEX CONCURRENTLY`, which doesn't block writes to the table, so
+they can be added while a study is running. Every statement must be safe to
+run again (e.g. `IF NOT EXISTS`), since on a new database `create_all` has
+usually made what they create already.
+"""
+
+# An arbitrary key for the advisory lock that keeps two API processes from
+# migrating the database at the same time
+MIGRATION_LOCK = 7_264_302
+
+# Each migration's version, description and the SQL statements that build
+# each of its indexes (by index name), in order. Never edit a migration once
+# it's released; add a new one instead.
+MIGRATIONS = [
+    (
+        1,
+        "Allow only one valid response per Prolific ID",
+        {
+            "response_prolific_id_valid": (
+                "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS response_prolific_id_valid "
+                "ON response (prolific_id) WHERE NOT garbage"
+            ),
+        },
+    ),
+    (
+        2,
+        "Index responses for duplicate checks and outcome counts",
+        {
+            "response_prolific_id": (
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS response_prolific_id "
+                "ON response (prolific_id)"
+            ),
+            "response_arm_id_batch_id_garbage": (
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS response_arm_id_batch_id_garbage "
+                "ON response (arm_id, batch_id, garbage)"
+            ),
+        },
+    ),
+    (
+        3,
+        "Index the parameters and pi of each batch",
+        {
+            "parameters_arm_id_batch_id": (
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS parameters_arm_id_batch_id "
+                "ON parameters (arm_id, batch_id)"
+            ),
+            "parameters_batch_id": (
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS parameters_batch_id "
+                "ON parameters (batch_id)"
+            ),
+            "pi_batch_id": (
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS pi_batch_id "
+                "ON pi (batch_id)"
+            ),
+        },
+    ),
+    (
+        4,
+        "Index the batches that can be current",
+        {
+            "batch_current": (
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS batch_current "
+                "ON batch (id) WHERE active AND remaining > 0"
+            ),
+        },
+    ),
+]
+
+
+def applied_versions(engine: Engine) -> set:
+    """The versions of the migrations already applied to the database"""
+    with Session(engine) as session:
+        return set(session.exec(select(SchemaVersion.version)).all())
+
+
+def drop_invalid_indexes(connection):
+    """
+    Drop the indexes left invalid by a migration's concurrent build that
+    failed, since `IF NOT EXISTS` would otherwise keep them from being built
+    again. Only the migrations' own indexes are dropped: any other index that
+    shows as invalid may still be being built by someone else.
+    """
+    names = [name for _, _, indexes in MIGRATIONS for name in indexes]
+    statement = text(
+        "SELECT c.relname FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE NOT i.indisvalid AND n.nspname = current_schema() "
+        "AND c.relname = ANY(:names)"
+    )
+    for name in connection.execute(statement, {"names": names}).scalars().all():
+        print(f"Dropping invalid index {name}")
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+
+
+def migrate(engine: Engine):
+    """Apply every migration that the database hasn't had yet, in order"""
+    # Concurrent index builds can't run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK})
+        try:
+            drop_invalid_indexes(conn)
+            applied = applied_versions(engine)
+            for version, description, indexes in MIGRATIONS:
+                if version in applied:
+                    continue
+                try:
+                    for statement in indexes.values():
+                        conn.execute(text(statement))
+                except IntegrityError:
+                    # Leave it to be tried again on the next start
+                    print(f"Duplicate rows exist; skipping migration {version}")
+                    drop_invalid_indexes(conn)
+                    continue
+                conn.execute(
+                    SchemaVersion.__table__.insert().values(
+                        version=version, description=description
+                    )
+                )
+                print(f"Applied migration {version}: {description}")
+        finally:
+            conn.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK}
+            )
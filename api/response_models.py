@@ -46,6 +46,29 @@ class ResponseJSON(BaseModel):
     garbage: bool
 
 
+class SubmissionJSON(BaseModel):
+    """
+    A class for validating a participant's submission via the API
+
+    prolific_id: The participant's Prolific ID, used to detect duplicates
+    response: The filled out survey form (see `ResponseJSON`)
+    noconsent: The record to store instead if consent was declined (see
+        `NoConsentJSON`). Exactly one of `response` and `noconsent` is given.
+    batch_size: The number of valid responses per batch
+    maximum: Whether the bandit searches for the max (or min) discriminatory
+        context
+    submission_id: A unique key for the submission. A submission sent again
+        with the same key isn't stored again; the first outcome is returned.
+    """
+
+    prolific_id: str | None
+    response: ResponseJSON | None = None
+    noconsent: NoConsentJSON | None = None
+    batch_size: int | None
+    maximum: bool | None
+    submission_id: str | None = None
+
+
 class ParametersJSON(BaseModel):
     """Validate Parameters data"""
 
@@ -1,8 +1,14 @@
+from datetime import datetime
+from sqlalchemy import Index, text
 from typing import List
 from sqlmodel import Field, Relationship, SQLModel
 
 """
 This script creates data models for each table in the database.
+
+The indexes declared here are created along with their tables on a new
+database. On an existing one, they're added by the migrations in
+`migrations.py`, which must be kept in step with them.
 """
 
 
@@ -26,8 +32,15 @@ class Bandit(SQLModel, table=True):
 class Batch(SQLModel, table=True):
     """
     A database table for recording the batch sizes and responses.
+
+    The batches that can be current (active with responses remaining) are
+    indexed, so the current batch can be found without a scan.
     """
 
+    __table_args__ = (
+        Index("batch_current", "id", postgresql_where=text("active AND remaining > 0")),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     remaining: int | None
     active: bool
@@ -37,6 +50,21 @@ class Batch(SQLModel, table=True):
     noconsent: List["NoConsent"] = Relationship(back_populates="batch")
 
 
+class CurrentBatch(SQLModel, table=True):
+    """
+    A single-row table pointing at the current batch, i.e. the most recent
+    batch that is active and has responses remaining. It's kept up to date as
+    batches are created and run out, so the current batch can be looked up by
+    primary key rather than by scanning `batch`.
+
+    id: Always 1
+    batch_id: The current batch, or None if it has run out
+    """
+
+    id: int = Field(default=1, primary_key=True)
+    batch_id: int | None = Field(default=None, foreign_key="batch.id")
+
+
 class Metadata(SQLModel, table=True):
     """
     A class for representing all the metadata that goes along with
@@ -68,6 +96,24 @@ class NoConsent(SQLModel, table=True):
     batch: Batch = Relationship(back_populates="noconsent")
 
 
+class Outcomes(SQLModel, table=True):
+    """
+    A class for the running success and failure counts of each bandit arm
+    within each batch. Rows are updated as valid responses come in, so the
+    posterior for a batch can be computed without scanning `response`.
+
+    batch_id: The batch the counts belong to
+    arm_id: The corresponding bandit arm
+    successes: Number of valid responses in which the user discriminated
+    failures: Number of valid responses in which the user did not discriminate
+    """
+
+    batch_id: int = Field(foreign_key="batch.id", primary_key=True)
+    arm_id: int = Field(foreign_key="bandit.id", primary_key=True)
+    successes: int = 0
+    failures: int = 0
+
+
 class Parameters(SQLModel, table=True):
     """
     A class for working with the `parameters` table in Postgres.
@@ -82,6 +128,11 @@ class Parameters(SQLModel, table=True):
     beta: The corresponding arm's beta parameter value
     """
 
+    __table_args__ = (
+        Index("parameters_arm_id_batch_id", "arm_id", "batch_id"),
+        Index("parameters_batch_id", "batch_id"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     arm_id: int = Field(foreign_key="bandit.id")
     batch_id: int = Field(foreign_key="batch.id")
@@ -97,6 +148,8 @@ class Pi(SQLModel, table=True):
     each arm is the most (or least) discriminatory arm.
     """
 
+    __table_args__ = (Index("pi_batch_id", "batch_id"),)
+
     id: int | None = Field(default=None, primary_key=True)
     batch_id: int = Field(foreign_key="batch.id")
     arm_id: int = Field(foreign_key="bandit.id")
@@ -105,6 +158,43 @@ class Pi(SQLModel, table=True):
     batch: "Batch" = Relationship(back_populates="pi")
 
 
+class SchemaVersion(SQLModel, table=True):
+    """
+    A record of the schema migrations applied to the database (see
+    `migrations.py`).
+
+    version: The migration's number
+    description: What the migration changed
+    applied_at: When the migration was applied
+    """
+
+    __tablename__ = "schema_version"
+
+    version: int = Field(primary_key=True, sa_column_kwargs={"autoincrement": False})
+    description: str
+    applied_at: datetime = Field(sa_column_kwargs={"server_default": text("now()")})
+
+
+class Submission(SQLModel, table=True):
+    """
+    A record of each submission handled by `POST /submit` and what came of
+    it, so that a submission that's sent again (e.g. after a timeout) gets
+    the same answer rather than being stored twice.
+
+    id: The submission's idempotency key, chosen by the client
+    duplicate: Whether the submission was a duplicate
+    batch_id: The batch created by the submission, if any
+    pause: Whether the Prolific study should be paused
+    redirect: Where the participant should be redirected
+    """
+
+    id: str = Field(primary_key=True)
+    duplicate: bool | None = None
+    batch_id: int | None = None
+    pause: bool | None = None
+    redirect: str | None = None
+
+
 class Response(SQLModel, table=True):
     """
     A class for creating and working with the `response` table in Postgres.
@@ -121,8 +211,22 @@ class Response(SQLModel, table=True):
     race: Demographics
     ethnicity: Demographics
     sex: Demographics
+
+    Each Prolific ID can have at most one valid (non-garbage) response, which
+    is enforced by a unique partial index.
     """
 
+    __table_args__ = (
+        Index(
+            "response_prolific_id_valid",
+            "prolific_id",
+            unique=True,
+            postgresql_where=text("NOT garbage"),
+        ),
+        Index("response_prolific_id", "prolific_id"),
+        Index("response_arm_id_batch_id_garbage", "arm_id", "batch_id", "garbage"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     arm_id: int = Field(foreign_key="bandit.id")
     batch_id: int = Field(foreign_key="batch.id")
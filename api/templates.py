@@ -0,0 +1,39 @@
+from types import MappingProxyType
+
+"""
+This script defines the HTML that the survey's candidate table is built from.
+The table skeleton and row labels never change, and within an arm each
+attribute can only be shown in one of two orders, so every row is rendered
+ahead of time (see `compile_rows`) and only shuffled and joined per request.
+"""
+
+# The table header and footer wrapped around the (shuffled) rows
+TABLE_HEAD = "<table><tbody><tr><th></th><th>Immigrant 1</th><th>Immigrant 2</th></tr>"
+TABLE_TAIL = "</tbody></table>"
+
+# One row per candidate attribute; the placeholders are filled with the
+# first and second candidate's values, respectively
+ROW_TEMPLATES = {
+    "prior_trips": (
+        "<tr><td>Prior trips to the U.S.</td><td>{}</td><td>{}<br></td></tr>"
+    ),
+    "education": "<tr><td>Education</td><td>{}<br></td><td>{}<br></td></tr>",
+    "reason": (
+        "<tr><td>Reason for application</td><td>{}<br></td><td>{}<br></td></tr>"
+    ),
+    "origin": "<tr><td>Country of origin</td><td>{}</td><td>{}</td></tr>",
+    "profession": "<tr><td>Profession</td><td>{}</td><td>{}</td></tr>",
+}
+
+
+def compile_rows(profiles: tuple) -> MappingProxyType:
+    """
+    Pre-render an arm's table rows. Takes the arm's two metadata profiles and
+    returns, for each attribute, a pair of rows: index 0 shows the profiles
+    in their stored order and index 1 shows them swapped.
+    """
+    rows = {}
+    for key, template in ROW_TEMPLATES.items():
+        values = (profiles[0][key], profiles[1][key])
+        rows[key] = (template.format(*values), template.format(*values[::-1]))
+    return MappingProxyType(rows)
@@ -65,9 +65,10 @@ json_pprint(req.get(base_url + "/responses/noconsent").json())
 deac = False
 json_pprint(req.get(base_url + f"/bandit/batch/current?deactivate={deac}").json())
 
-# Get live summary of responses
-responses = pd.DataFrame(req.get(base_url + "/responses").json())
-responses_noconsent = pd.DataFrame(req.get(base_url + "/responses/noconsent").json())
+# Get live summary of responses (whole tables are exported as CSV, which
+# pandas reads much faster than the JSON endpoints)
+responses = pd.read_csv(base_url + "/export/responses")
+responses_noconsent = pd.read_csv(base_url + "/export/noconsent")
 perc_discriminated = round(
     responses[responses.garbage != True].discriminated.sum()
     / len(responses[responses.garbage != True])
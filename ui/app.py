@@ -10,7 +10,13 @@ from ui_no_consent import no_consent_ui
 from ui_outro import outro_ui
 from ui_postsurvey import attention_ui
 from ui_survey import survey_ui
-from utils_db import current_batch, current_context, submit
+from utils_db import (
+    current_batch,
+    current_context,
+    start_retry_log,
+    submissions,
+    submit,
+)
 from utils_prolific import prolific_redirect
 from utils_ui import (
     empty_age,
@@ -72,6 +78,11 @@ def server(input: Inputs, output: Outputs, session: Session):
     # Initialize the response form
     response_form = ResponseForm()
 
+    # Make sure submissions left over from before a restart get delivered
+    submissions.start()
+    # Log the API call counters, to spot retry storms
+    start_retry_log()
+
     # Logic for 'Next Page' button on landing page.
     #
     # This function uses the async keyword because we want to call the
@@ -116,14 +127,14 @@ def server(input: Inputs, output: Outputs, session: Session):
             await session.send_custom_message("scroll_top", "")
             # Update the response form
             response_form.consent = False
-            # Submit the response form and handle batch/parameter updating
-            # Get the current batch
-            cur_batch = current_batch(deactivate=True)
-            response_form.batch_id = cur_batch["id"]
-            submit(response_form, None, None, maximum=PROB_MAXIMIZE, noconsent=True)
+            # Queue the response form; it's assigned to the current batch and
+            # the batches are updated in the background
+            redirect = await submit(
+                response_form, None, maximum=PROB_MAXIMIZE, noconsent=True
+            )
             # Redirect to the Prolific No-Consent page
             await session.send_custom_message(
-                "redirect_url", prolific_redirect("noconsent")
+                "redirect_url", prolific_redirect(redirect)
             )
 
     # Logic for 'Next Page' on the consent page
@@ -288,8 +299,8 @@ def server(input: Inputs, output: Outputs, session: Session):
             await session.send_custom_message("scroll_top", "")
             # Retrieve the current context and dynamically generate the
             # survey tables. See `/ui/ui_survey.py`!
-            cur_batch = current_batch()
-            cur_context = current_context(cur_batch["id"])
+            cur_batch = await current_batch()
+            cur_context = await current_context(cur_batch["id"])
 
             ui.insert_ui(
                 ui.HTML(cur_context["html_content"]),
@@ -365,16 +376,12 @@ def server(input: Inputs, output: Outputs, session: Session):
             ui.update_navs("hidden_tabs", selected="panel_outro")
             # Update the response form
             response_form.option_attention = int(attention)
-            # Ensure user is rolled into the current active batch
-            cur_batch = current_batch(deactivate=True)
-            response_form.batch_id = cur_batch["id"]
-            # Submit the response form and handle batch/parameter updating
-            submit(
-                response_form, response_form.batch_id, BATCH_SIZE, maximum=PROB_MAXIMIZE
-            )
+            # Queue the response form; it's rolled into the current active
+            # batch and the batches are updated in the background
+            redirect = await submit(response_form, BATCH_SIZE, maximum=PROB_MAXIMIZE)
             # Now redirect to Prolific
             await session.send_custom_message(
-                "redirect_url", prolific_redirect("valid")
+                "redirect_url", prolific_redirect(redirect)
             )
 
 
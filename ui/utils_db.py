@@ -1,21 +1,34 @@
-import requests as req
+import asyncio
+import httpx
+import json
 import os
+import random
 import time
 import traceback
+import uuid
+from collections import Counter
+from functools import wraps
+from inspect import iscoroutinefunction
 from utils_prolific import pause_prolific_study
 
 """
 This script defines utility functions for interacting with the database.
 To see all the api endpoints utilized here, see `/api/main.py`.
+
+The helpers are coroutines that share one keep-alive `httpx.AsyncClient`, so
+calling them from the app's reactive effects never blocks the event loop (and
+with it every other participant on this replica). Only `initialize_bandit`,
+which runs once at startup before the event loop, is synchronous.
+
+Submissions are handed to a background queue (see `SubmissionQueue`) rather
+than sent to the API while the participant waits, so they're redirected to
+Prolific as soon as they're done.
 """
 
 env_vars = os.environ
 
 ADAPTIVE_TESTING = env_vars.get("ADAPTIVE_TESTING")
 API_HOST_PORT = env_vars["API_HOST_PORT"]
-STOPPAGE_THRESHOLD = float(env_vars["STOPPAGE_THRESHOLD"])
-STUDY_MAX_N = float(env_vars["STUDY_MAX_N"])
-WARMUP_N = float(env_vars["WARMUP_N"])
 
 if ADAPTIVE_TESTING is not None and ADAPTIVE_TESTING:
     network = "localhost"
@@ -25,30 +38,365 @@ else:
 # Construct the url for querying the API
 api_url = f"http://{network}:{API_HOST_PORT}"
 
+# Connection pool limits and timeouts (in seconds) for the API client
+API_MAX_CONNECTIONS = 20
+API_MAX_KEEPALIVE_CONNECTIONS = 10
+API_KEEPALIVE_EXPIRY = 30
+API_CONNECT_TIMEOUT = 2
+API_TIMEOUT = 10
+
+# The client shared by all API calls. Connections are kept alive and reused.
+client = httpx.AsyncClient(
+    base_url=api_url,
+    limits=httpx.Limits(
+        max_connections=API_MAX_CONNECTIONS,
+        max_keepalive_connections=API_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=API_KEEPALIVE_EXPIRY,
+    ),
+    timeout=httpx.Timeout(API_TIMEOUT, connect=API_CONNECT_TIMEOUT),
+)
+
+# The file that holds submissions until the API has stored them (in the
+# `journal` directory, which is mounted as a volume so that it outlives the
+# container; see `docker-compose.yml`), how many submissions are sent to the API at once, how long (in
+# seconds) to wait before resending one that couldn't be delivered, and how
+# many times to try before setting it aside
+SUBMISSION_JOURNAL = env_vars.get(
+    "SUBMISSION_JOURNAL", os.path.join("journal", "submissions.jsonl")
+)
+SUBMISSION_WORKERS = 4
+SUBMISSION_RETRY_DELAY = 5
+SUBMISSION_MAX_ATTEMPTS = 100
+
+# The journal is rewritten with just the pending submissions once it grows
+# past this size (in bytes), or past twice its size after the last rewrite
+SUBMISSION_JOURNAL_LIMIT = 1_000_000
+
+# Retry policy for API calls: up to `RETRY_ATTEMPTS` attempts, all within
+# `RETRY_DEADLINE` seconds, with randomized ("jittered") exponential backoff
+# between them so that the replicas don't all retry in lockstep
+RETRY_ATTEMPTS = 10
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 3
+RETRY_DEADLINE = 20
+
+# Consecutive failed calls after which the API is considered down, and for
+# how long (in seconds) calls then fail fast
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 10
+
+# How often (in seconds) to log `retry_counts` while they're changing
+RETRY_LOG_INTERVAL = 60
+
+
+class CircuitBreaker:
+    """
+    Stops calling the API for a while once it's clearly unhealthy.
+
+    After `threshold` consecutive calls have failed (each once its own
+    retries have run out, see `with_retry`) the circuit "opens" and calls
+    fail fast, without touching the network, for `cooldown` seconds. After
+    that a single trial call is let through: if it succeeds the circuit
+    closes again, otherwise it stays open for another `cooldown`.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead"""
+        if self.opened is None:
+            return True
+        if time.monotonic() - self.opened < self.cooldown:
+            return False
+        # Restarting the cooldown keeps other calls out during the trial
+        self.opened = time.monotonic()
+        self.trial = True
+        return True
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or (self.opened is None and self.failures >= self.threshold):
+            if self.opened is None:
+                retry_counts["circuit_opened"] += 1
+                print("API is failing; opening the circuit breaker")
+            self.opened = time.monotonic()
+        self.trial = False
+
+    def record_success(self):
+        if self.opened is not None:
+            print("API has recovered; closing the circuit breaker")
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+
+# Shared by all API calls, as they all depend on the same API being healthy
+breaker = CircuitBreaker(CIRCUIT_THRESHOLD, CIRCUIT_COOLDOWN)
+
+# How many API calls were made, retried, failed (after retrying, or with an
+# error not worth retrying) or short-circuited, and how often the circuit
+# opened, for spotting retry storms (see `log_retry_counts`)
+retry_counts = Counter()
+
+# The task that logs `retry_counts` (see `start_retry_log`)
+retry_log = None
+
+
+def backoff(attempt: int) -> float:
+    """How long to wait before retry number `attempt` (full jitter)"""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+async def log_retry_counts():
+    """Log `retry_counts` every `RETRY_LOG_INTERVAL` seconds if they changed"""
+    logged = None
+    while True:
+        await asyncio.sleep(RETRY_LOG_INTERVAL)
+        counts = dict(retry_counts)
+        if counts != logged:
+            print("API calls: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+            logged = counts
+
+
+def retryable(error: Exception) -> bool:
+    """
+    Whether a failed API call is worth retrying: the API couldn't be reached,
+    timed out, failed (5xx) or asked us to slow down (429). Anything else,
+    e.g. a client error (4xx) or a bug on our side, will fail the same way
+    again.
+    """
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return False
+
+
+def start_retry_log():
+    """Start logging `retry_counts` in the background (only once)"""
+    global retry_log
+    if retry_log is None:
+        retry_log = asyncio.create_task(log_retry_counts())
+
 
 def with_retry(f):
-    """A decorator to retry API queries if they fail"""
+    """
+    A decorator to retry API queries (sync or async) if they fail. See
+    `RETRY_ATTEMPTS` and `RETRY_DEADLINE` for the retry policy and
+    `CircuitBreaker` for when calls fail fast instead.
+    """
 
+    if iscoroutinefunction(f):
+
+        @wraps(f)
+        async def async_wrapper(*args, **kwargs):
+            if not breaker.allow():
+                retry_counts["short_circuited"] += 1
+                raise ConnectionError("API circuit breaker is open")
+            deadline = time.monotonic() + RETRY_DEADLINE
+            for attempt in range(RETRY_ATTEMPTS):
+                retry_counts["calls" if attempt == 0 else "retries"] += 1
+                try:
+                    remaining = deadline - time.monotonic()
+                    result = await asyncio.wait_for(f(*args, **kwargs), remaining)
+                    breaker.record_success()
+                    return result
+                except Exception as error:
+                    exception_message = traceback.format_exc()
+                    if not retryable(error):
+                        retry_counts["errors"] += 1
+                        # Only a response from the API says anything about
+                        # its health
+                        if isinstance(error, httpx.HTTPStatusError):
+                            breaker.record_success()
+                        raise
+                delay = backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                await asyncio.sleep(delay)
+            # The call as a whole failed, which counts against the API once
+            retry_counts["failures"] += 1
+            breaker.record_failure()
+            raise ConnectionError(exception_message)
+
+        return async_wrapper
+
+    @wraps(f)
     def wrapper(*args, **kwargs):
-        iter = 0
-        while iter < 10:
+        deadline = time.monotonic() + RETRY_DEADLINE
+        for attempt in range(RETRY_ATTEMPTS):
+            retry_counts["calls" if attempt == 0 else "retries"] += 1
             try:
                 result = f(*args, **kwargs)
                 return result
-            except Exception:
-                time.sleep(0.1)
-                iter += 1
+            except Exception as error:
                 exception_message = traceback.format_exc()
+                if not retryable(error):
+                    retry_counts["errors"] += 1
+                    raise
+            delay = backoff(attempt)
+            if time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+        retry_counts["failures"] += 1
         raise ConnectionError(exception_message)
 
     return wrapper
 
 
+class SubmissionQueue:
+    """
+    Delivers participants' submissions to the API in the background.
+
+    Each submission is appended to a journal file, and synced to disk (in a
+    worker thread, so that a slow disk doesn't hold up the other sessions),
+    before it's queued and is only dropped from it once the API has stored
+    it, so anything still pending when the app goes down is delivered after
+    it restarts. Delivery is at-least-once: a submission may be sent again
+    if the API stored it but the app never heard back (it timed out, or the
+    app went down). Each submission is sent with its journal key as its
+    `submission_id`, so the API stores it only once and answers a resend with
+    the outcome of the first delivery. Submissions the API rejects outright,
+    or that still haven't been delivered after
+    `SUBMISSION_MAX_ATTEMPTS` tries, are set aside in a `.rejected` file next
+    to the journal.
+    """
+
+    def __init__(self, path: str, workers: int):
+        self.path = path
+        self.workers = workers
+        self.pending = {}
+        self.attempts = Counter()
+        self.compacted = 0
+        self.queue = None
+        self.tasks = []
+
+    def compact(self):
+        """Rewrite the journal with just the pending submissions"""
+        # Write the new journal alongside the old one and then swap them, so
+        # that going down in between doesn't lose anything
+        with open(self.path + ".new", "w") as journal:
+            for key, submission in self.pending.items():
+                journal.write(json.dumps({"id": key, "submission": submission}))
+                journal.write("\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(self.path + ".new", self.path)
+        self.compacted = os.path.getsize(self.path)
+
+    def done(self, key: str):
+        """Drop a delivered submission from the journal"""
+        del self.pending[key]
+        self.attempts.pop(key, None)
+        if not self.pending:
+            # Nothing left to deliver, so start the journal over
+            open(self.path, "w").close()
+            self.compacted = 0
+            return
+        self.write(self.path, {"id": key, "done": True})
+        size = os.path.getsize(self.path)
+        if size > max(SUBMISSION_JOURNAL_LIMIT, 2 * self.compacted):
+            self.compact()
+
+    def load(self):
+        """Read the submissions that are still pending from the journal"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A partly written entry, from going down mid-write
+                    continue
+                if entry.get("done"):
+                    self.pending.pop(entry["id"], None)
+                else:
+                    self.pending[entry["id"]] = entry["submission"]
+        if self.pending:
+            print(f"Resending {len(self.pending)} pending submission(s)")
+
+    async def put(self, submission: dict):
+        """Record a submission in the journal and queue it for delivery"""
+        self.start()
+        key = uuid.uuid4().hex
+        # It's pending before it's written, so that a rewrite of the journal
+        # in the meantime (see `compact`) keeps it
+        self.pending[key] = submission
+        entry = {"id": key, "submission": submission}
+        await asyncio.to_thread(self.write, self.path, entry, sync=True)
+        self.queue.put_nowait(key)
+
+    async def reject(self, key: str):
+        """Set aside a submission that can't be delivered"""
+        path = self.path + ".rejected"
+        await asyncio.to_thread(self.write, path, self.pending[key], sync=True)
+        self.done(key)
+
+    def start(self):
+        """Queue any pending submissions and start delivering (only once)"""
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        self.load()
+        for key in self.pending:
+            self.queue.put_nowait(key)
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def work(self):
+        """Deliver queued submissions, one at a time, until cancelled"""
+        while True:
+            key = await self.queue.get()
+            try:
+                await deliver_submission(dict(self.pending[key], submission_id=key))
+            except Exception as error:
+                traceback.print_exc()
+                if isinstance(error, httpx.HTTPStatusError) and not retryable(error):
+                    # The API will never accept it
+                    await self.reject(key)
+                    continue
+                self.attempts[key] += 1
+                if self.attempts[key] >= SUBMISSION_MAX_ATTEMPTS:
+                    print("Submission still not delivered; setting it aside")
+                    await self.reject(key)
+                    continue
+                print(
+                    f"Submission not delivered; retrying in {SUBMISSION_RETRY_DELAY}s"
+                )
+                await asyncio.sleep(SUBMISSION_RETRY_DELAY)
+                self.queue.put_nowait(key)
+            else:
+                self.done(key)
+
+    @staticmethod
+    def write(path: str, entry: dict, sync: bool = False):
+        """
+        Append an entry to a journal file. With `sync`, return only once it's
+        on disk.
+        """
+        with open(path, "a") as journal:
+            journal.write(json.dumps(entry) + "\n")
+            if sync:
+                journal.flush()
+                os.fsync(journal.fileno())
+
+
+# The submissions waiting to be sent to the API (see `submit`)
+submissions = SubmissionQueue(SUBMISSION_JOURNAL, SUBMISSION_WORKERS)
+
+
 @with_retry
-def current_batch(deactivate: bool = False):
+async def current_batch(deactivate: bool = False):
     """Retrieves the current batch information"""
-    current_batch_request = req.get(
-        api_url + f"/bandit/batch/current/?deactivate={deactivate}"
+    current_batch_request = await client.get(
+        f"/bandit/batch/current?deactivate={deactivate}"
     )
     current_batch_request.raise_for_status()
     current_batch = current_batch_request.json()
@@ -56,9 +404,9 @@ def current_batch(deactivate: bool = False):
 
 
 @with_retry
-def current_context(batch_id: int):
+async def current_context(batch_id: int):
     """Retrieves (randomly) the context for the current user session"""
-    context_request = req.get(api_url + f"/randomize?batch_id={batch_id}")
+    context_request = await client.get(f"/randomize?batch_id={batch_id}")
     context_request.raise_for_status()
     context = context_request.json()
     ## TODO: Remove this at some point (currently helpful for interactive use)
@@ -66,152 +414,67 @@ def current_context(batch_id: int):
     return context
 
 
-def current_pi():
-    """Retrieves the current-batch individual pi values"""
-    cur_batch = current_batch()
-    resp = req.get(api_url + "/bandit/batch")
-    resp.raise_for_status()
-    [cur_params] = [x for x in resp.json() if x["batch"]["id"] == cur_batch["id"]]
-    pi_vals = [x["pi"] for x in cur_params["pi"]]
-    for i in range(len(pi_vals) - 1, 0, -1):
-        pi_vals[i] = pi_vals[i] - pi_vals[(i - 1)]
-    return pi_vals
-
-
-def decrement_batch_remaining(batch_id: int, active: bool = True):
-    """Decrement the batch `remaining` parameter. Can also deactivate batch"""
-    (
-        req.post(
-            api_url
-            + f"/bandit/batch/decrement?batch_id={str(batch_id)}"
-            + f"&active={active}"
-        ).raise_for_status()
-    )
-
-
-def finished_warmup() -> True:
-    if num_responses() > WARMUP_N:
-        return True
-    return False
-
-
-@with_retry
-def get_batch_id(batch_id: int):
-    """Get specific batch"""
-    batch_request = req.get(api_url + f"/bandit/batch?batch_id={str(batch_id)}")
-    batch_request.raise_for_status()
-    batch = batch_request.json()
-    return batch
-
-
-def increment_batch(
-    batch_id: int, remaining: int, active: bool = True, maximum: bool = True
-):
-    """Ping the api to create a new batch in the Batch database table"""
-    (
-        req.post(
-            api_url + "/bandit/batch",
-            json={
-                "batch_id": batch_id,
-                "remaining": remaining,
-                "active": active,
-                "maximum": maximum,
-            },
-        ).raise_for_status()
-    )
+async def deliver_submission(submission: dict):
+    """
+    Sends a queued submission to the API. The submission is assigned to the
+    current batch and the API stores the form (in the NoConsent table if it's
+    flagged as "noconsent", otherwise in the Responses table) and updates the
+    batches in a single transaction, unless the individual has already
+    submitted a response. Pauses the Prolific study if the API says so.
+    """
+    noconsent = "noconsent" in submission
+    form = submission["noconsent" if noconsent else "response"]
+    form["batch_id"] = (await current_batch(deactivate=True))["id"]
+    outcome = await post_submission(submission)
+    # If the study has reached its maximum size or an arm exceeds the
+    # stoppage threshold, pause the Prolific study
+    if outcome["pause"]:
+        print("Stopping criterion reached; stopping Prolific study")
+        await asyncio.to_thread(pause_prolific_study)
 
 
 def initialize_bandit(bandit: dict) -> None:
     """Function to create the initial Bandit database table"""
-    bandit_req = req.get(api_url + "/bandit")
+    bandit_req = httpx.get(api_url + "/bandit")
     bandit_req.raise_for_status()
     if not bandit_req.json():
-        req.post(api_url + "/bandit", json=bandit).raise_for_status()
+        httpx.post(api_url + "/bandit", json=bandit).raise_for_status()
 
 
-@with_retry
-def is_duplicate_id(prolific_id: str) -> bool:
-    """Checks if user response already exists"""
-    resp = req.post(api_url + f"/responses/duplicated?prolific_id={prolific_id}")
+async def post_submission(submission: dict) -> dict:
+    """
+    Sends a submission to the API and returns the API's verdict. It's sent
+    just once; `SubmissionQueue` takes care of resending it.
+    """
+    resp = await client.post("/submit", json=submission)
     resp.raise_for_status()
     return resp.json()
 
 
-@with_retry
-def num_responses() -> int:
-    resp_request = req.get(api_url + "/responses")
-    resp_request.raise_for_status()
-    return len(resp_request.json())
-
-
-def submit(
+async def submit(
     response_form,
-    batch_id: int | None,
     batch_size: int | None,
     maximum: bool | None,
     noconsent: bool = False,
-) -> None:
+) -> str:
     """
-    Handles the logistics of submitting the response form. If the individual
-    has already submitted a response, nothing happens. Otherwise, if the form is
-    flagged as "noconsent" it will be submitted to the NoConsent table,
-    otherwise it is stored in the Responses table.
+    Handles the logistics of submitting the response form. The form is
+    queued to be sent to the API in the background (see
+    `deliver_submission`), and where the participant should be redirected is
+    returned right away.
     """
-    duplicate_response = is_duplicate_id(response_form.prolific_id)
-    # If the response is a duplicate we just want to do nothing.
-    if duplicate_response:
-        return None
     response_form.validate_data()
     response_form_data = response_form.generate_form()
+    submission = {
+        "prolific_id": response_form.prolific_id,
+        "batch_size": batch_size,
+        "maximum": maximum,
+    }
     if noconsent:
-        submit_response_noconsent(response_form_data)
-    else:
-        submit_response(response_form_data)
-    # Update batches and corresponding parameters if the form is valid
-    # and if we have ended the warm-up phase of receiving responses
-    if not response_form.garbage and finished_warmup():
-        update_batch(batch_id, batch_size, maximum=maximum)
-    # If we have exceeded the max number of survey responses, pause the
-    # Prolific study
-    if num_responses() >= STUDY_MAX_N:
-        print("Max number of respondents required; stopping Prolific study")
-        pause_prolific_study()
-
-
-def submit_response(form: dict) -> None:
-    """Submit a filled-out survey form via the API"""
-    url = api_url + "/responses"
-    req.post(url, json=form).raise_for_status()
-
-
-def submit_response_noconsent(form: dict) -> None:
-    """Submit a survey form when consent is declined via the API"""
-    url = api_url + "/responses/noconsent"
-    resp_form = {}
-    for key in ["batch_id", "consent"]:
-        resp_form[key] = form[key]
-    req.post(url, json=resp_form).raise_for_status()
-
-
-def update_batch(batch_id: int, remaining: int, maximum: bool):
-    """
-    Decrement batch counter, and create new batch/pi/parameters as necessary.
-    Also check if any arm exceeds the stoppage threshold. If so, pause the
-    Prolific survey.
-    """
-    batch = get_batch_id(batch_id)
-    ready_to_update = batch["remaining"] <= 1
-    batch_is_active = batch["active"]
-    if ready_to_update and batch_is_active:
-        decrement_batch_remaining(batch["id"], active=False)
-        increment_batch(batch["id"], remaining=remaining, maximum=maximum)
-        # Check if any of the new arm pi values exceed stoppage threshold
-        pi_vals = current_pi()
-        print(f"Current pi vals: {pi_vals}")
-        # If any pi values exceed stoppage threshold
-        if any([x >= STOPPAGE_THRESHOLD for x in pi_vals]):
-            pause_prolific_study()
-    elif ready_to_update and not batch_is_active:
-        decrement_batch_remaining(batch["id"], active=False)
+        submission["noconsent"] = {
+            key: response_form_data[key] for key in ["batch_id", "consent"]
+        }
     else:
-        decrement_batch_remaining(batch["id"])
+        submission["response"] = response_form_data
+    await submissions.put(submission)
+    return "noconsent" if noconsent else "valid"
@@ -1,7 +1,7 @@
 import requests as req
 from shiny import Session, ui
 from urllib.parse import urlparse, parse_qs
-from utils_db import api_url, is_duplicate_id
+from utils_db import api_url
 
 """
 This script defines utility functions for interacting with the user interface.
@@ -56,9 +56,6 @@ class ResponseForm:
     def validate_data(self) -> None:
         # Indicator if the response is garbage or not
         garbage = False
-        # If a Prolific ID has already responded, mark as garbage
-        if self.prolific_id is not None and is_duplicate_id(self.prolific_id):
-            garbage = True
         if not self.in_usa:
             garbage = True
         if self.commitment in ["no", "unsure"]: